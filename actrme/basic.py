@@ -1,8 +1,13 @@
+from collections.abc import Mapping, Sequence
 from numbers import Number
+import copy
+import pickle
+import zlib
 
 import numpy as np
 from enum import Enum
 from heapq import *
+from time import perf_counter
 
 def boltzmann(values, temperature):
     """Returns a Boltzmann distribution of the probabilities of each option"""
@@ -12,6 +17,280 @@ def boltzmann(values, temperature):
     return bvals
 
 
+# Version of the binary format of snapshots
+SNAPSHOT_FORMAT = 1
+
+
+def pack_state(state):
+    """Serializes the state of a module or model into compact, compressed bytes"""
+    return zlib.compress(pickle.dumps((SNAPSHOT_FORMAT, state), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_state(data):
+    """Reads the state serialized by pack_state"""
+    version, state = pickle.loads(zlib.decompress(data))
+    if version != SNAPSHOT_FORMAT:
+        raise ValueError("Unsupported snapshot format %s" % version)
+    return state
+
+
+class Symbol:
+    """A slot name or value interned in the symbol table
+
+    There is a single symbol per value, so symbols compare and hash by identity; they
+    never compare equal to other objects (numbers included), and print as the value
+    they stand for"""
+    __slots__ = ("_index",)
+
+    def __init__(self, index):
+        self._index = index
+
+    @property
+    def value(self):
+        return symbols.value(self)
+
+    def __repr__(self):
+        return repr(symbols.value(self))
+
+    def __str__(self):
+        return str(symbols.value(self))
+
+    def __reduce__(self):
+        # Symbol numbers are only meaningful within a process; re-intern the value
+        return intern, (symbols.value(self),)
+
+
+class SymbolTable:
+    """A two-way mapping between hashable values and the symbols that stand for them"""
+
+    def __init__(self):
+        self._symbols = {}
+        self._values = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def intern(self, value):
+        """Returns the symbol for a value, creating it if needed"""
+        if type(value) is Symbol or isinstance(value, Number):
+            return value
+        symbol = self._symbols.get(value)
+        if symbol is None:
+            symbol = Symbol(len(self._values))
+            self._values.append(value)
+            self._symbols[value] = symbol
+        return symbol
+
+    def lookup(self, value):
+        """Returns the symbol for a value, or None if it has none, without creating it
+
+        Values that cannot be interned (unhashable ones) have no symbol"""
+        if type(value) is Symbol or isinstance(value, Number):
+            return value
+        try:
+            return self._symbols.get(value)
+        except TypeError:
+            return None
+
+    def value(self, symbol):
+        """Returns the value a symbol stands for"""
+        return self._values[symbol._index]
+
+
+symbols = SymbolTable()
+
+
+def intern(value):
+    """Returns the symbol of a value in the shared symbol table
+
+    Numbers are not interned: they are returned unchanged, so that numeric values
+    keep their type and do not grow the table. They compare as Python numbers, so
+    1, 1.0 and True are equal slot values, as they are in a dictionary"""
+    return symbols.intern(value)
+
+
+def lookup(value):
+    """Returns the symbol of a value in the shared symbol table, or None if it has none
+
+    Unlike intern, it never adds to the table, so it is used to look values up"""
+    return symbols.lookup(value)
+
+
+def extern(value):
+    """Returns the readable value of a symbol (other values are returned unchanged)"""
+    if type(value) is Symbol:
+        return symbols._values[value._index]
+    return value
+
+
+def _order(value):
+    """Sort key of interned slots: numbers first, then symbols in order of creation"""
+    return (1, value._index) if type(value) is Symbol else (0, value)
+
+
+def intern_contents(contents):
+    """Returns a copy of a slot-value dictionary with interned slots and values"""
+    return {intern(slot): intern(value) for slot, value in contents.items()}
+
+
+def lookup_items(contents):
+    """Returns the interned (slot, value) pairs of a chunk or of a slot-value dictionary,
+    without adding to the symbol table: slots and values without a symbol are None"""
+    if type(contents) is Chunk:
+        return contents.interned_items()
+    return tuple((lookup(slot), lookup(value)) for slot, value in contents.items())
+
+
+def extern_contents(contents):
+    """Returns a copy of a slot-value dictionary with readable slots and values"""
+    return {extern(slot): extern(value) for slot, value in contents.items()}
+
+
+class Schema:
+    """The sorted tuple of slots of a chunk. Schemas are shared by all chunks with the same slots"""
+    __slots__ = ("slots", "positions", "_extensions")
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.positions = {slot: i for i, slot in enumerate(slots)}
+        self._extensions = {}
+
+    def extend(self, slot):
+        """Returns the schema with one more slot, and the position of that slot in it"""
+        extension = self._extensions.get(slot)
+        if extension is None:
+            slots = tuple(sorted(self.slots + (slot,), key=_order))
+            extension = self._extensions[slot] = (schema(slots), slots.index(slot))
+        return extension
+
+    def __repr__(self):
+        return "<Schema %s>" % (self.slots,)
+
+
+_schemas = {}
+
+
+def schema(slots):
+    """Returns the shared schema of a sorted tuple of interned slots"""
+    shared = _schemas.get(slots)
+    if shared is None:
+        shared = _schemas[slots] = Schema(slots)
+    return shared
+
+
+class Chunk(Mapping):
+    """An immutable collection of interned slot-value pairs
+
+    Chunks can be shared freely between memories, IOs and outputs. Deriving a chunk
+    with one more (or one changed) slot reuses the schema and copies only the tuple
+    of values. Reading a chunk as a mapping returns the readable slots and values;
+    interned_items() returns them as stored"""
+    __slots__ = ("_schema", "_values", "_hash")
+
+    def __init__(self, contents=()):
+        if isinstance(contents, Chunk):
+            self._schema = contents._schema
+            self._values = contents._values
+        else:
+            items = sorted(((intern(slot), intern(value)) for slot, value in dict(contents).items()),
+                           key=lambda item: _order(item[0]))
+            self._schema = schema(tuple(slot for slot, _ in items))
+            self._values = tuple(value for _, value in items)
+        self._hash = None
+
+    @classmethod
+    def _make(cls, shared, values):
+        chunk = cls.__new__(cls)
+        chunk._schema = shared
+        chunk._values = values
+        chunk._hash = None
+        return chunk
+
+    @property
+    def schema(self):
+        return self._schema
+
+    def __getitem__(self, slot):
+        i = self._schema.positions.get(lookup(slot))
+        if i is None:
+            raise KeyError(slot)
+        return extern(self._values[i])
+
+    def get(self, slot, default=None):
+        i = self._schema.positions.get(lookup(slot))
+        return default if i is None else extern(self._values[i])
+
+    def __contains__(self, slot):
+        return lookup(slot) in self._schema.positions
+
+    def __iter__(self):
+        return (extern(slot) for slot in self._schema.slots)
+
+    def __len__(self):
+        return len(self._values)
+
+    def interned_items(self):
+        """Returns the (slot, value) pairs as they are stored, with interned symbols, as a tuple"""
+        return tuple(zip(self._schema.slots, self._values))
+
+    def set(self, slot, value):
+        """Returns a chunk with a slot added or changed"""
+        slot = intern(slot)
+        value = intern(value)
+        i = self._schema.positions.get(slot)
+        if i is not None:
+            if self._values[i] == value:
+                return self
+            return Chunk._make(self._schema, self._values[:i] + (value,) + self._values[i + 1:])
+        extended, i = self._schema.extend(slot)
+        return Chunk._make(extended, self._values[:i] + (value,) + self._values[i:])
+
+    def update(self, contents):
+        """Returns a chunk with several slots added or changed"""
+        chunk = self
+        for slot, value in contents.items():
+            chunk = chunk.set(slot, value)
+        return chunk
+
+    def __eq__(self, other):
+        if isinstance(other, Chunk):
+            return self._schema is other._schema and self._values == other._values
+        if isinstance(other, Mapping):
+            if len(other) != len(self._values):
+                return False
+            positions = self._schema.positions
+            for slot, value in other.items():
+                i = positions.get(lookup(slot))
+                if i is None:
+                    return False
+                value = lookup(value)
+                if value is None or self._values[i] != value:
+                    return False
+            return True
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self._schema.slots, self._values))
+        return self._hash
+
+    def __reduce__(self):
+        return Chunk, (dict(self.interned_items()),)
+
+    def __repr__(self):
+        return "{%s}" % ", ".join("%r: %r" % item for item in self.items())
+
+
+def make_chunk(contents):
+    """Returns contents as a chunk, without a copy if it already is one"""
+    if type(contents) is Chunk:
+        return contents
+    return Chunk(contents)
+
+
 class Representation(dict):
     """A generic symbol class. This is still experimental and not used"""
     # Add comparisons for efficiency
@@ -35,8 +314,17 @@ class Direction(Enum):
     IN = 1
     OUT = 2
 
+class EventType(Enum):
+    """Numeric constants for the kinds of traced events"""
+    ENCODE = 1
+    RETRIEVE = 2
+    FAILURE = 3
+    PROPAGATE = 4
+    SCHEDULE = 5
+
 class ActrIO:
     """A generic interface between a module or a model and any other component"""
+    __slots__ = ("_name", "_value", "_direction", "_owner")
 
     def __init__(self, name, owner=None, direction=Direction.IN):
         self._name = name
@@ -84,11 +372,15 @@ class ActrIO:
 
 
 class SymbolicIO(ActrIO):
-    """A symbolic input. A symbol is a collection of slot-value pairs"""
+    """A symbolic input. A symbol is a collection of slot-value pairs
+
+    The value is an immutable Chunk (see Chunk), which reads as a mapping of plain
+    slots and values"""
+    __slots__ = ()
 
     def __init__(self, name, owner=None, direction=Direction.IN):
         super().__init__(name=name, owner=owner, direction=direction)
-        self._value = {}
+        self._value = Chunk()
 
     @property
     def value(self):
@@ -96,18 +388,17 @@ class SymbolicIO(ActrIO):
 
     @value.setter
     def value(self, newvalue):
-        assert isinstance(newvalue, dict), "Value is not dictionary"
-        if not isinstance(newvalue, dict):
+        assert isinstance(newvalue, Mapping), "Value is not dictionary"
+        if not isinstance(newvalue, Mapping):
             return
-        super(SymbolicIO, self.__class__).value.fset(self, newvalue)
+        super(SymbolicIO, self.__class__).value.fset(self, make_chunk(newvalue))
 
     def modify(self, newvalue):
         """Adds new slot-values to symbol"""
-        assert isinstance(newvalue, dict), "Value is not dictionary"
-        if not isinstance(newvalue, dict):
+        assert isinstance(newvalue, Mapping), "Value is not dictionary"
+        if not isinstance(newvalue, Mapping):
             return
-        for key, value in newvalue.items():
-            self.value[key] = value
+        self._value = self._value.update(newvalue)
 
     def __str__(self):
         desc = "(..Sym)"
@@ -120,6 +411,8 @@ class SymbolicIO(ActrIO):
 
 
 class NumericIO(ActrIO):
+    __slots__ = ()
+
     def __init__(self, name, owner=None, direction=Direction.IN):
         ActrIO.__init__(self, name=name, owner=owner, direction=direction)
         self._value = 0
@@ -147,7 +440,7 @@ class ProbabilityIO(NumericIO):
     """
 This is just a numeric IO that forces values in [0,1]. Might not use because
 probability densities might in fact exceed 1"""
-    pass
+    __slots__ = ()
 
 class Pipe:
     """A pipe is a connection between an ActrIO and a different objects"""
@@ -242,6 +535,8 @@ class InputOutput:
 
 class Connection:
     """A connection between two entities"""
+    __slots__ = ("_source", "_destination")
+
     def __init__(self, source, destination):
         self._source = source
         self._destination = destination
@@ -255,7 +550,12 @@ class Connection:
         return self._destination
 
 class ModuleConnection(Connection):
-    """A connection between two modules"""
+    """A connection between two modules
+
+    The combination of source, destination and logic is resolved once, when the
+    connection is created or its logic changes, into a single transfer function"""
+    __slots__ = ("_logic", "_transfer")
+
     def __init__(self, source, destination, logic=None):
         assert isinstance(source, ActrIO)
         assert source.direction == Direction.OUT
@@ -263,6 +563,8 @@ class ModuleConnection(Connection):
         assert destination.direction == Direction.IN
         Connection.__init__(self, source, destination)
         self._logic = logic
+        self._transfer = None
+        self.compile()
 
     @property
     def logic(self):
@@ -271,70 +573,309 @@ class ModuleConnection(Connection):
     @logic.setter
     def logic(self, logic):
         self._logic = logic
+        self.compile()
 
-    def propagate(self, module):
-        """Propagate the values of an IO from one module to another"""
+    def compile(self):
+        """Resolves the transfer function from the IO types and the logic of the connection"""
         source = self._source
         destination = self._destination
+        logic = self._logic
 
         if isinstance(source, NumericIO):
-            value = source.value
-            if  isinstance(destination, NumericIO):
-                destination.value = value
+            if isinstance(destination, NumericIO):
+                def transfer():
+                    destination.value = source.value
 
             elif isinstance(destination, SymbolicIO):
-                if self._logic is None:
-                    logic = source.name
-                else:
-                    assert isinstance(self._logic, str), "Logic must be a key name to transfer number to SymbolicIO"
-                    logic = self._logic
-                destination.value[logic] = value
+                key = source.name if logic is None else logic
+                if not isinstance(key, str):
+                    raise ValueError("Logic must be a key name to transfer number to SymbolicIO")
+                key = intern(key)
+
+                def transfer():
+                    destination._value = destination._value.set(key, source.value)
 
             else:
                 raise ValueError("Unknown destination type: %s" % type(destination))
 
         elif isinstance(source, SymbolicIO):
-            value = source.value
-
             if isinstance(destination, NumericIO):
-                assert self._logic is not None, "Logic cannot be None between symbolic and numeric IOs"
-                assert isinstance(self._logic, str), "Logic must be a key name to transfer symbolic info to to NumericIO"
-                destination.value[self.logic] = value
+                if logic is None:
+                    raise ValueError("Logic cannot be None between symbolic and numeric IOs")
+                if not isinstance(logic, str):
+                    raise ValueError("Logic must be a key name to transfer symbolic info to NumericIO")
+                key = intern(logic)
+
+                def transfer():
+                    destination.value = float(extern(source.value[key]))
 
             elif isinstance(destination, SymbolicIO):
-                if self._logic is None:
+                if logic is None:
                     # Copy the whole dictionary
-                    destination.value = value
+                    def transfer():
+                        destination.value = source.value
+
+                elif isinstance(logic, str):
+                    key = intern(logic)
 
-                elif isinstance(self._logic, Sequence):
-                    for key in self._logic:
-                        destination.value[key] = value[key]
+                    def transfer():
+                        destination._value = destination._value.set(key, source.value[key])
 
-                elif isinstance(self._logic, dict):
+                elif isinstance(logic, dict):
                     # We translate from one key to another
-                    for oldkey, newkey in self._logic.items():
-                        destination.value[newkey] = value[oldkey]
+                    pairs = [(intern(oldkey), intern(newkey)) for oldkey, newkey in logic.items()]
+
+                    def transfer():
+                        value = source.value
+                        for oldkey, newkey in pairs:
+                            destination._value = destination._value.set(newkey, value[oldkey])
 
-                elif isinstance(self._logic, str):
-                    destination.value[self._logic] = value[self._logic]
+                elif isinstance(logic, Sequence):
+                    keys = [intern(key) for key in logic]
+
+                    def transfer():
+                        value = source.value
+                        for key in keys:
+                            destination._value = destination._value.set(key, value[key])
 
                 else:
-                    raise ValueError("Unknown logic type: %s" % type(self._logic))
+                    raise ValueError("Unknown logic type: %s" % type(logic))
+
+            else:
+                raise ValueError("Unknown destination type: %s" % type(destination))
 
         else:
             raise ValueError("Unknown source type: %s" % type(source))
 
+        self._transfer = transfer
+
+    def propagate(self, module=None):
+        """Propagate the values of an IO from one module to another"""
+        self._transfer()
+
+    def __getstate__(self):
+        # Transfer functions are closures; they are rebuilt after unpickling
+        return self._source, self._destination, self._logic
+
+    def __setstate__(self, state):
+        self._source, self._destination, self._logic = state
+        self.compile()
+
+class Tracer:
+    """Records typed events into preallocated columns used as a ring buffer
+
+    Each event has a time, a type (EventType), a source (module), an optional chunk
+    and an optional numeric value. When more events than the capacity are recorded,
+    the oldest ones are overwritten"""
+
+    def __init__(self, capacity=100000):
+        assert capacity > 0
+        self._times = np.empty(capacity, dtype=float)
+        self._types = np.empty(capacity, dtype=np.int8)
+        self._sources = np.empty(capacity, dtype=object)
+        self._chunks = np.empty(capacity, dtype=object)
+        self._values = np.empty(capacity, dtype=float)
+        self._count = 0
+
+    @property
+    def capacity(self):
+        return len(self._times)
+
+    def __len__(self):
+        return min(self._count, len(self._times))
+
+    @property
+    def dropped(self):
+        """Number of events overwritten because the buffer was full"""
+        return max(0, self._count - len(self._times))
+
+    def record(self, event, time, source, chunk=None, value=np.nan):
+        """Records an event"""
+        i = self._count % len(self._times)
+        self._times[i] = time
+        self._types[i] = event.value
+        self._sources[i] = source
+        self._chunks[i] = chunk
+        self._values[i] = value
+        self._count += 1
+
+    def clear(self):
+        self._count = 0
+        self._sources[:] = None
+        self._chunks[:] = None
+
+    def _order(self):
+        """Returns the buffer positions of the stored events, oldest first"""
+        capacity = len(self._times)
+        if self._count <= capacity:
+            return np.arange(self._count)
+        return (np.arange(capacity) + self._count) % capacity
+
+    def to_dataframe(self):
+        """Returns the stored events, oldest first, as a pandas DataFrame"""
+        import pandas as pd
+        order = self._order()
+        names = {event.value: event.name.lower() for event in EventType}
+        return pd.DataFrame({
+            "time": self._times[order],
+            "event": [names[t] for t in self._types[order]],
+            "source": [getattr(x, "name", x) for x in self._sources[order]],
+            "chunk": [None if c is None else extern_contents(c) for c in self._chunks[order]],
+            "value": self._values[order],
+        })
+
+
+class ProfileSummary:
+    """A summary of the activity recorded by a Profiler"""
+
+    def __init__(self, modules, propagations, queue_samples, mean_queue_depth, max_queue_depth,
+                 conflict_sets, mean_conflict_set, max_conflict_set, retrievals, failures):
+        self.modules = modules
+        self.propagations = propagations
+        self.queue_samples = queue_samples
+        self.mean_queue_depth = mean_queue_depth
+        self.max_queue_depth = max_queue_depth
+        self.conflict_sets = conflict_sets
+        self.mean_conflict_set = mean_conflict_set
+        self.max_conflict_set = max_conflict_set
+        self.retrievals = retrievals
+        self.failures = failures
+
+    @property
+    def failure_rate(self):
+        return self.failures / self.retrievals if self.retrievals > 0 else np.nan
+
+    def __repr__(self):
+        lines = ["<ProfileSummary propagations=%d queue depth mean=%.2f max=%d "
+                 "conflict set mean=%.2f max=%d retrievals=%d failure rate=%.3f>"
+                 % (self.propagations, self.mean_queue_depth, self.max_queue_depth, self.mean_conflict_set,
+                    self.max_conflict_set, self.retrievals, self.failure_rate)]
+        for name, (runs, seconds) in self.modules.items():
+            lines.append("  %s: %d runs, %.6f s" % (name, runs, seconds))
+        return "\n".join(lines)
+
+
+class Profiler:
+    """Counts the activity of a model and its modules: time spent in each module,
+    propagations, scheduler queue depth, conflict-set sizes and retrieval failures"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._module_runs = {}
+        self._module_seconds = {}
+        self.propagations = 0
+        self._queue_samples = 0
+        self._queue_total = 0
+        self._queue_max = 0
+        self._conflict_sets = 0
+        self._conflict_total = 0
+        self._conflict_max = 0
+        self.retrievals = 0
+        self.failures = 0
+
+    def module_run(self, module, seconds):
+        self._module_runs[module] = self._module_runs.get(module, 0) + 1
+        self._module_seconds[module] = self._module_seconds.get(module, 0.0) + seconds
+
+    def queue_depth(self, depth):
+        self._queue_samples += 1
+        self._queue_total += depth
+        if depth > self._queue_max:
+            self._queue_max = depth
+
+    def conflict_set(self, size):
+        self._conflict_sets += 1
+        self._conflict_total += size
+        if size > self._conflict_max:
+            self._conflict_max = size
+
+    def retrieval(self, failed):
+        self.retrievals += 1
+        if failed:
+            self.failures += 1
+
+    def summary(self):
+        """Returns a ProfileSummary of everything recorded since the last reset"""
+        modules = {str(getattr(module, "name", module)): (runs, self._module_seconds[module])
+                   for module, runs in self._module_runs.items()}
+        return ProfileSummary(modules, self.propagations, self._queue_samples,
+                              self._queue_total / self._queue_samples if self._queue_samples else 0.0,
+                              self._queue_max, self._conflict_sets,
+                              self._conflict_total / self._conflict_sets if self._conflict_sets else 0.0,
+                              self._conflict_max, self.retrievals, self.failures)
+
+
 class Module(TimeKeeper, InputOutput):
     """A generic module class"""
 
     def __init__(self, name="GenericModule"):
+        TimeKeeper.__init__(self)
         InputOutput.__init__(self)
         self._name = name
         self._model = None
         self._duration = 0.0
         self._duration_probability = 1.0
         self._probability = 1.0
+        self._priority = 0
+        self._event_driven = False
+        self._analytic = False
+        self._tracer = None
+        self._profiler = None
+        self._rng = None
+        self._uniforms = np.empty(0)
+        self._next_uniform = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def rng(self):
+        """The numpy Generator the module samples from (a fresh, unseeded one by default)"""
+        if self._rng is None:
+            self._rng = np.random.default_rng()
+        return self._rng
+
+    @rng.setter
+    def rng(self, rng):
+        assert isinstance(rng, np.random.Generator)
+        self._rng = rng
+        self._uniforms = np.empty(0)
+        self._next_uniform = 0
+
+    def uniform(self):
+        """Returns the next uniform sample in [0, 1) of the module's stream
+
+        Samples are drawn from the generator in blocks; the sequence is the same as
+        drawing them one at a time"""
+        if self._next_uniform == len(self._uniforms):
+            self._uniforms = self.rng.random(1024)
+            self._next_uniform = 0
+        u = self._uniforms[self._next_uniform]
+        self._next_uniform += 1
+        return u
+
+    @property
+    def tracer(self):
+        """The Tracer that records the module's events, or None (the default) to record nothing"""
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        assert tracer is None or isinstance(tracer, Tracer)
+        self._tracer = tracer
+
+    @property
+    def profiler(self):
+        """The Profiler that counts the module's activity, or None (the default)"""
+        return self._profiler
 
+    @profiler.setter
+    def profiler(self, profiler):
+        assert profiler is None or isinstance(profiler, Profiler)
+        self._profiler = profiler
 
     @property
     def model(self):
@@ -381,11 +922,96 @@ class Module(TimeKeeper, InputOutput):
         assert probability >= 0.0
         self._probability = probability
 
+    @property
+    def priority(self):
+        """Modules with a lower priority run first when scheduled at the same time"""
+        return self._priority
+
+    @priority.setter
+    def priority(self, priority):
+        assert isinstance(priority, Number)
+        self._priority = priority
+        if self._model is not None:
+            self._model._connections_from = None  # Rebuild the schedule
+
+    @property
+    def event_driven(self):
+        """Whether the module depends on the timing of events (and so always needs the event scheduler)"""
+        return self._event_driven
+
+    @event_driven.setter
+    def event_driven(self, value):
+        assert isinstance(value, bool)
+        self._event_driven = value
+        if self._model is not None:
+            self._model._connections_from = None  # Rebuild the schedule
+
+    @property
+    def analytic(self):
+        """When True, the module predicts the distribution of its outcomes instead of sampling them"""
+        return self._analytic
+
+    @analytic.setter
+    def analytic(self, value):
+        assert isinstance(value, bool)
+        self._analytic = value
+
+    def reset(self):
+        """Returns the module to its initial state"""
+        self.time = 0
+
+    def state(self):
+        """Returns the state of the module (its time and the values of its IOs) as plain, picklable data
+
+        Modules with an internal state extend it"""
+        return {"time": self.time,
+                "inputs": [x.value for x in self._inputs],
+                "outputs": [x.value for x in self._outputs]}
+
+    def set_state(self, state):
+        """Sets the state returned by state()"""
+        self.time = state["time"]
+        for x, value in zip(self._inputs, state["inputs"]):
+            x._value = value
+        for x, value in zip(self._outputs, state["outputs"]):
+            x._value = value
+
+    def snapshot(self):
+        """Returns the state of the module as compact bytes"""
+        return pack_state(self.state())
+
+    def restore(self, data):
+        """Returns the module to the state of a snapshot"""
+        self.set_state(unpack_state(data))
+
+    def fork(self):
+        """Returns an independent copy of the module, with its own IOs and not part of any model
+
+        The fork keeps the tracer and profiler of the module, and continues from the same
+        state of its random stream (set its rng to make them differ)"""
+        memo = {id(self._model): None, id(self._tracer): self._tracer, id(self._profiler): self._profiler}
+        return copy.deepcopy(self, memo)
+
     def run(self):
         # Applies all the functions
         # Returns time
         pass
 
+    def log_likelihood(self, observations):
+        """Returns the log-likelihood of observed values of the module's outputs after an analytic run
+
+        Observations are (output, extract, value) tuples. Returns None when the run
+        made no prediction about them, which is all a module without a likelihood does"""
+        return None
+
+    # Names of the parameters log_likelihood_gradient can differentiate
+    gradient_parameters = ()
+
+    def log_likelihood_gradient(self, observations, parameters):
+        """Returns the log-likelihood of observed values after an analytic run and its gradient
+        (an array) with respect to the named parameters, or None if nothing was predicted"""
+        return None
+
     def __str__(self):
         return "<%s [module]>" % (self._name)
 
@@ -399,15 +1025,72 @@ class Model(TimeKeeper, InputOutput):
         self._time_output = NumericIO("rt", direction=Direction.OUT, owner=self)
         self.add_input(self._time_input)
         self.add_output(self._time_output)
+        self._connections = []
+        self._connections_from = None  # Connections grouped by source module, built by finalize()
+        self._input_modules = []
+        self._static_schedule = None
+        self._static_chain = False
+        self._tracer = None
+        self._profiler = None
+        self._quiescent = True
+        self._rng = None
         self._id = 0
 
     @TimeKeeper.time.setter
     def time(self, newtime):
         """Updates the internal time and the time of all modules"""
-        self._time_input = newtime
+        self._time = newtime
         for module in self._modules:
             module.time = newtime
 
+    def reset(self):
+        """Resets the time and the state of all modules"""
+        self.time = 0
+        for module in self._modules:
+            module.reset()
+
+    def state(self):
+        """Returns the state of the model and of all of its modules as plain, picklable data"""
+        return {"time": self.time,
+                "io": [self._time_input.value, self._time_output.value],
+                "modules": [(type(module).__name__, module.state()) for module in self._modules]}
+
+    def set_state(self, state):
+        """Sets the state returned by state() of a model with the same modules"""
+        assert [type(m).__name__ for m in self._modules] == [name for name, _ in state["modules"]], \
+            "The state is not one of a model with the same modules"
+        self._time = state["time"]
+        self._time_input._value, self._time_output._value = state["io"]
+        for module, (_, module_state) in zip(self._modules, state["modules"]):
+            module.set_state(module_state)
+
+    def snapshot(self):
+        """Returns the state of the model and of its modules (memories, time, IO values) as compact bytes"""
+        return pack_state(self.state())
+
+    def restore(self, data):
+        """Returns the model and its modules to the state of a snapshot"""
+        self.set_state(unpack_state(data))
+
+    def fork(self):
+        """Returns an independent copy of the model that continues from its current state
+
+        Modules fork themselves (declarative memories share their history copy-on-write);
+        the fork shares the data of the model, its tracer and its profiler"""
+        memo = {id(self._tracer): self._tracer, id(self._profiler): self._profiler}
+        dataframe = getattr(self, "_dataframe", None)
+        if dataframe is not None:
+            memo[id(dataframe)] = dataframe
+        for module in self._modules:
+            fork = module.fork()
+            memo[id(module)] = fork
+            for old, new in zip(module.inputs + module.outputs, fork.inputs + fork.outputs):
+                memo[id(old)] = new
+        model = copy.deepcopy(self, memo)
+        for module in model.modules:
+            module._model = model
+        return model
+
     @property
     def modules(self):
         return self._modules
@@ -416,6 +1099,14 @@ class Model(TimeKeeper, InputOutput):
         """Adds a module"""
         assert isinstance(mod, Module)
         self._modules.append(mod)
+        if self._tracer is not None:
+            mod.tracer = self._tracer
+        if self._profiler is not None:
+            mod.profiler = self._profiler
+        if self._rng is not None:
+            mod.rng = self._rng.spawn(1)[0]
+        mod._model = self
+        self._connections_from = None
 
     def remove_module(self, mod):
         """Removes a module"""
@@ -426,8 +1117,131 @@ class Model(TimeKeeper, InputOutput):
         if len(mod_inputs) > 0:
             for input in mod_inputs:
                 self.inputs.remove(input)
+        # Remove any connections to or from that module
+        self._connections = [c for c in self._connections
+                             if c.source.owner is not mod and c.destination.owner is not mod]
         # Remove the module itself
         self._modules.remove(mod)
+        mod._model = None
+        self._connections_from = None
+
+    @property
+    def connections(self):
+        return self._connections
+
+    def connect(self, source, destination, logic=None):
+        """Connects the output of a module to the input of another one
+
+        Invalid combinations of IO types and logic raise a ValueError here rather
+        than during a run"""
+        assert source.owner in self._modules, "Owner %s of source not amongst modules" % source.owner
+        assert destination.owner in self._modules, "Owner %s of destination not amongst modules" % destination.owner
+        connection = ModuleConnection(source, destination, logic)
+        self._connections.append(connection)
+        self._connections_from = None
+        return connection
+
+    def finalize(self):
+        """Compiles the connections of the model into per-module transfer plans"""
+        connections_from = {module: [] for module in self._modules}
+        for connection in self._connections:
+            connection.compile()
+            connections_from[connection.source.owner].append(connection)
+        self._connections_from = connections_from
+        self._input_modules = [m for m in dict.fromkeys(x.owner for x in self.inputs) if isinstance(m, Module)]
+        self._static_schedule = self._schedule()
+
+    def _schedule(self):
+        """Returns a fixed execution plan if a run is a single pass through the modules, else None
+
+        That is the case when the modules reachable from the inputs form an acyclic
+        graph in which no module has more than one upstream module, no input module
+        has an upstream module, and no module is event-driven. Each entry is
+        (module, its outgoing connections, indices of its downstream entries), with
+        the input modules first. The plan is a chain when there is a single input
+        module and no module has more than one downstream module"""
+        downstream = {}
+        upstream = {}
+        reachable = list(self._input_modules)
+        seen = set(reachable)
+        for module in reachable:
+            targets = list(dict.fromkeys(c.destination.owner for c in self._connections_from[module]
+                                         if isinstance(c.destination.owner, Module)))
+            downstream[module] = targets
+            for target in targets:
+                upstream.setdefault(target, []).append(module)
+                if target not in seen:
+                    seen.add(target)
+                    reachable.append(target)
+
+        # Kahn's algorithm
+        indegree = {module: len(upstream.get(module, [])) for module in reachable}
+        order = [module for module in reachable if indegree[module] == 0]
+        for module in order:
+            for target in downstream[module]:
+                indegree[target] -= 1
+                if indegree[target] == 0:
+                    order.append(target)
+        if len(order) < len(reachable):
+            return None  # Cyclic
+
+        if any(module.event_driven for module in order):
+            return None
+        if any(len(upstream.get(module, [])) > 0 for module in self._input_modules):
+            return None
+        if any(len(sources) > 1 for sources in upstream.values()):
+            return None
+        position = {module: i for i, module in enumerate(order)}
+        self._static_chain = (len(self._input_modules) == 1
+                              and all(len(targets) <= 1 for targets in downstream.values()))
+        return [(module, self._connections_from[module], [position[target] for target in downstream[module]])
+                for module in order]
+
+    @property
+    def tracer(self):
+        """The Tracer that records the events of the model and of its modules, or None"""
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        assert tracer is None or isinstance(tracer, Tracer)
+        self._tracer = tracer
+        for module in self._modules:
+            module.tracer = tracer
+
+    @property
+    def profiler(self):
+        """The Profiler that counts the activity of the model and of its modules, or None"""
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        assert profiler is None or isinstance(profiler, Profiler)
+        self._profiler = profiler
+        for module in self._modules:
+            module.profiler = profiler
+
+    @property
+    def rng(self):
+        """The numpy Generator the modules' streams are spawned from, or None"""
+        return self._rng
+
+    @rng.setter
+    def rng(self, rng):
+        """Gives every module its own independent child stream of the generator, in module order
+
+        Accepts a Generator, or anything numpy.random.default_rng accepts (a seed or a
+        SeedSequence), so that a run is reproducible bit for bit"""
+        if not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+        self._rng = rng
+        for module, child in zip(self._modules, rng.spawn(len(self._modules))):
+            module.rng = child
+
+    @property
+    def quiescent(self):
+        """Whether the last run stopped because no events were left (rather than at a limit)"""
+        return self._quiescent
 
     def add_input(self, input):
         """Adds an input to the model. The input must come from one of its modules"""
@@ -435,6 +1249,7 @@ class Model(TimeKeeper, InputOutput):
         assert input.direction == Direction.IN
         assert input.owner == self or input.owner in self._modules, "Owner %s of input not amongst modules" % (input.owner)
         self._inputs.append(input)
+        self._connections_from = None
 
 
     def add_output(self, output):
@@ -449,36 +1264,183 @@ class Model(TimeKeeper, InputOutput):
         self._id += 1
         return self._id
 
-    def run(self, max=10000):
-        """Generic run function"""
-        # This should be a simple generic function that runs through all the
-        # non-empty input modules and propagates them until the model is stable.
-        # (e.g., no more cognitive cycles).
-
-        schedule = []
+    def run(self, max_events=10000, max_time=None):
+        """Runs the modules that received inputs, and those downstream of them, until the model is stable
+
+        Events are ordered by (time, priority, sequence). A module takes the duration
+        returned by its run function (or its duration if it returns None); its outputs
+        are propagated at the end of that duration, which schedules the modules
+        connected to them. The run stops when no events are left (quiescence), after
+        max_events events, or when the next event is more than max_time after the
+        start. Returns the time taken"""
+        if self._connections_from is None:
+            self.finalize()
+        if self._static_schedule is not None and max_time is None and max_events >= len(self._static_schedule):
+            return self._run_static()
+        connections_from = self._connections_from
+        tracer = self._tracer
+        profiler = self._profiler
+        start = self._time
+        finish = start
+        deadline = None if max_time is None else start + max_time
+        # Events are (time, priority, sequence, module, deliver); deliver events
+        # propagate the outputs of a module at the end of its run
+        queue = []
+        single = None  # The only pending event, kept out of the heap
+        pending = set()  # (module, time) of scheduled runs
+        sequence = 0
 
         # Initialize the scheduler
-        for module in set([x.owner for x in self.inputs]):
-            print("input owned by %s)" % (module))
-            if isinstance(module, Module):
-                heappush(schedule, (self._time, module))
-
-        while len(schedule) > 0:
-            newtime, module = heappop(schedule)
-
-            if t > self._time:
-                self.time = t
-            module.run()
-            for output in module.outputs:
-                for connection in output.connections:
-                    connection.propagate()
-                    if isinstance(connection.destination, Module):
-                        heappush(schedule, (module.time, connection.destination))
-
+        for module in self._input_modules:
+            if tracer is not None:
+                tracer.record(EventType.SCHEDULE, start, module)
+            event = (start, module.priority, sequence, module, False)
+            sequence += 1
+            pending.add((module, start))
+            if single is None and len(queue) == 0:
+                single = event
+            else:
+                if single is not None:
+                    heappush(queue, single)
+                    single = None
+                heappush(queue, event)
+
+        events = 0
+        while single is not None or len(queue) > 0:
+            if events >= max_events:
+                break
+            event = single if single is not None else queue[0]
+            newtime, _, _, module, deliver = event
+            if deadline is not None and newtime > deadline:
+                break
+            if single is not None:
+                single = None
+            else:
+                heappop(queue)
+            events += 1
+            if profiler is not None:
+                profiler.queue_depth(len(queue) + (single is not None))
+            if newtime > self._time:
+                self.time = newtime
+
+            if not deliver:
+                pending.discard((module, newtime))
+                if profiler is None:
+                    duration = module.run()
+                else:
+                    clock = perf_counter()
+                    duration = module.run()
+                    profiler.module_run(module, perf_counter() - clock)
+                if duration is None:
+                    duration = module.duration
+                end = newtime + duration
+                if end > finish:
+                    finish = end
+                if duration > 0:
+                    event = (end, module.priority, sequence, module, True)
+                    sequence += 1
+                    if single is None and len(queue) == 0:
+                        single = event
+                    else:
+                        if single is not None:
+                            heappush(queue, single)
+                            single = None
+                        heappush(queue, event)
+                    continue
+
+            for connection in connections_from[module]:
+                connection.propagate(module)
+                destination = connection.destination.owner
+                if tracer is not None:
+                    tracer.record(EventType.PROPAGATE, newtime, module)
+                if profiler is not None:
+                    profiler.propagations += 1
+                if isinstance(destination, Module) and (destination, newtime) not in pending:
+                    if tracer is not None:
+                        tracer.record(EventType.SCHEDULE, newtime, destination)
+                    event = (newtime, destination.priority, sequence, destination, False)
+                    sequence += 1
+                    pending.add((destination, newtime))
+                    if single is None and len(queue) == 0:
+                        single = event
+                    else:
+                        if single is not None:
+                            heappush(queue, single)
+                            single = None
+                        heappush(queue, event)
+
+        self._quiescent = single is None and len(queue) == 0
+        elapsed = finish - start
+        self._time_output.value = elapsed
+        return elapsed
+
+    def _run_static(self):
+        """Runs each module once from the precomputed plan, starting when its upstream module ends
+
+        A chain runs straight through. Otherwise the modules run in the order of the event
+        scheduler, by (start time, priority, sequence), the sequence counting the modules in
+        the order they became ready"""
+        schedule = self._static_schedule
+        start = self._time
+        finish = start
+        if self._static_chain:
+            begin = start
+            for module, connections, _ in schedule:
+                end = self._run_scheduled(module, begin, connections)
+                if end > finish:
+                    finish = end
+                begin = end
+        else:
+            ready = []
+            sequence = 0
+            for index in range(len(self._input_modules)):
+                heappush(ready, (start, schedule[index][0].priority, sequence, index))
+                sequence += 1
+            while len(ready) > 0:
+                begin, _, _, index = heappop(ready)
+                module, connections, targets = schedule[index]
+                end = self._run_scheduled(module, begin, connections)
+                if end > finish:
+                    finish = end
+                for target in targets:
+                    heappush(ready, (end, schedule[target][0].priority, sequence, target))
+                    sequence += 1
+        if finish > self._time:
+            self.time = finish
+        self._quiescent = True
+        elapsed = finish - start
+        self._time_output.value = elapsed
+        return elapsed
+
+    def _run_scheduled(self, module, begin, connections):
+        """Runs a module of the static plan at time begin, propagates its outputs and returns when it ends"""
+        tracer = self._tracer
+        profiler = self._profiler
+        if tracer is not None:
+            tracer.record(EventType.SCHEDULE, begin, module)
+        module.time = begin
+        if profiler is None:
+            duration = module.run()
+        else:
+            clock = perf_counter()
+            duration = module.run()
+            profiler.module_run(module, perf_counter() - clock)
+        if duration is None:
+            duration = module.duration
+        end = begin + duration
+        for connection in connections:
+            connection.propagate(module)
+            if tracer is not None:
+                tracer.record(EventType.PROPAGATE, end, module)
+            if profiler is not None:
+                profiler.propagations += 1
+        return end
 
 
 class DataInputMapping:
     """An input mapping a mapping from a column of a dataframe to a module input"""
+    __slots__ = ("_source", "_destination", "_rename")
+
     def __init__(self, source, destination, rename):
         self._source = source
         self._destination = destination
@@ -495,14 +1457,15 @@ class DataInputMapping:
         return self._rename
 
     def __str__(self):
-        name = '' if self._name == None else '%s' % self._name
-        return "<Value %s From '%s' To '%s'>" % (name, self._source.name, self._destination)
+        name = '' if self._rename == None else '%s' % self._rename
+        return "<Value %s From '%s' To %s>" % (name, self._source, self._destination.name)
 
     def __repr__(self):
         return self.__str__()
 
 class DataOutputMapping:
     """An output mapping from  module output to column of a dataframe"""
+    __slots__ = ("_source", "_destination", "_extract")
 
     def __init__(self, source, destination, extract=None, rename=None):
         self._source = source
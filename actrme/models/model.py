@@ -1,5 +1,400 @@
 import actrme.basic as basic
+from actrme.modules.declarative import DeclarativeMemory, TraceLags
+import numpy as np
 import pandas as pd
+import pickle
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from numbers import Number
+
+
+def _missing(value):
+    """Empty cells (NaN, None or empty strings) do not reach the model"""
+    return value is None or value == "" or (isinstance(value, float) and np.isnan(value))
+
+
+def _column_values(series, symbolic):
+    """Converts a dataframe column to a list of interned symbols (or floats), with None for empty cells"""
+    if symbolic:
+        interned = {}
+        values = []
+        for v in series.tolist():
+            symbol = interned.get(v)
+            if symbol is None and not _missing(v):
+                symbol = interned[v] = basic.intern(str(v))
+            values.append(symbol)
+        return values
+    return [None if _missing(v) else float(v) for v in series.tolist()]
+
+
+class Parameter:
+    """A free parameter: a numeric attribute of a module, with the bounds of its search space"""
+
+    def __init__(self, module, name, lower, upper, start=None, label=None):
+        assert isinstance(module, basic.Module), "Not a module: %s" % module
+        assert isinstance(getattr(module, name), Number), "Not a numeric attribute: %s" % name
+        assert lower < upper, "Lower bound must be below upper bound"
+        if start is None:
+            start = getattr(module, name)
+            if not lower <= start <= upper:
+                start = (lower + upper) / 2
+        assert lower <= start <= upper, "Start value out of bounds"
+        self._module = module
+        self._name = name
+        self._lower = lower
+        self._upper = upper
+        self._start = start
+        self._label = name if label is None else label
+
+    @property
+    def module(self):
+        return self._module
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def lower(self):
+        return self._lower
+
+    @property
+    def upper(self):
+        return self._upper
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def label(self):
+        return self._label
+
+    @property
+    def value(self):
+        return getattr(self._module, self._name)
+
+    @value.setter
+    def value(self, value):
+        setattr(self._module, self._name, float(value))
+
+    def __repr__(self):
+        return "<Parameter %s in [%s, %s]>" % (self._label, self._lower, self._upper)
+
+
+class FitResult:
+    """The outcome of a maximum-likelihood fit"""
+
+    def __init__(self, parameters, log_likelihood, observations, evaluations, success=True, message="",
+                 profile=None, cache_hits=0, cache_misses=0):
+        self.parameters = parameters
+        self.log_likelihood = log_likelihood
+        self.observations = observations
+        self.evaluations = evaluations
+        self.success = success
+        self.message = message
+        self.profile = profile
+        self.cache_hits = cache_hits
+        self.cache_misses = cache_misses
+
+    @property
+    def cache_hit_rate(self):
+        """The fraction of evaluations answered by the evaluation cache (None without a cache)"""
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups > 0 else None
+
+    @property
+    def aic(self):
+        return 2 * len(self.parameters) - 2 * self.log_likelihood
+
+    @property
+    def bic(self):
+        return len(self.parameters) * np.log(self.observations) - 2 * self.log_likelihood
+
+    def __repr__(self):
+        cache = "" if self.cache_hit_rate is None else " cache hit rate=%.2f" % self.cache_hit_rate
+        return "<FitResult LL=%.3f AIC=%.3f BIC=%.3f n=%d evaluations=%d%s %s>" % (
+            self.log_likelihood, self.aic, self.bic, self.observations, self.evaluations, cache, self.parameters)
+
+
+class EvaluationCache:
+    """A bounded, least-recently-used cache of objective evaluations
+
+    Entries are keyed on a fingerprint of the data and of the fixed parts of the model,
+    and on the parameter vector rounded to a number of decimals (the default keeps the
+    small steps of finite-difference gradients apart). With a path, the cache is loaded
+    from that file if it exists and saved to it every save_every new entries and at the
+    end of every fit, so that an interrupted session resumes without paying again"""
+
+    def __init__(self, maxsize=4096, decimals=10, path=None, save_every=100):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.path = path
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._unsaved = 0
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                self._entries = pickle.load(f)
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else None
+
+    def key(self, fingerprint, x):
+        return fingerprint, tuple(round(float(v), self.decimals) for v in x)
+
+    def get(self, key, gradient=False):
+        """Returns the cached (value, gradient) of a key, or None; gradient requires one to be cached"""
+        entry = self._entries.get(key)
+        if entry is None or (gradient and entry[1] is None):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, value, gradient=None):
+        self._entries[key] = (value, gradient)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self._unsaved += 1
+        if self.path is not None and self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        """Writes the entries to the cache file, atomically"""
+        if self.path is None:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump(self._entries, f)
+        os.replace(temporary, self.path)
+        self._unsaved = 0
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+# Bounded scipy.optimize.minimize methods that use a gradient
+_gradient_methods = ("L-BFGS-B", "TNC", "SLSQP", "trust-constr")
+
+# A pickled (model, parameters) pair, unpickled afresh by every task of a worker process
+_worker_template = None
+
+
+def _initialize_worker(template):
+    global _worker_template
+    _worker_template = template
+
+
+def _fit_group(key, dataframe, seed, method, options):
+    """Fits one group of rows with its own copy of the model and its own random stream
+
+    seed is the group's SeedSequence: the modules get child streams of it, and the
+    global numpy state, which some optimizers draw from, is seeded from it too"""
+    model, parameters = pickle.loads(_worker_template)
+    model.dataframe = dataframe
+    model.rng = np.random.default_rng(seed)
+    np.random.seed(seed.generate_state(1))
+    return key, model.fit(parameters, method=method, options=options)
+
+
+# The (model, parameters, plan) of a sweep, unpickled once per worker process
+_sweep_state = None
+
+
+def _initialize_sweep(template):
+    global _sweep_state
+    _sweep_state = template
+
+
+def _sweep_points(points):
+    """Evaluates the log-likelihood at every row of points, in order"""
+    global _sweep_state
+    if isinstance(_sweep_state, bytes):
+        _sweep_state = pickle.loads(_sweep_state)
+    model, parameters, plan = _sweep_state
+    results = np.empty(len(points))
+    for k, x in enumerate(points):
+        for parameter, value in zip(parameters, x):
+            parameter.value = value
+        if isinstance(plan, PrecompiledLikelihood):
+            results[k] = plan.log_likelihood()[0]
+        else:
+            results[k] = model.log_likelihood(plan)[0]
+    return results
+
+
+def latin_hypercube(parameters, samples, seed=None):
+    """Returns samples points spread over the bounds of the parameters by Latin hypercube sampling:
+    each parameter's range is cut into samples strata, each stratum is sampled exactly once"""
+    rng = np.random.default_rng(seed)
+    lower = np.array([p.lower for p in parameters], dtype=float)
+    upper = np.array([p.upper for p in parameters], dtype=float)
+    strata = np.column_stack([rng.permutation(samples) for _ in parameters])
+    unit = (strata + rng.random((samples, len(parameters)))) / samples
+    return lower + unit * (upper - lower)
+
+
+def grid(parameters, levels):
+    """Returns the Cartesian grid of the parameters: levels is either a number of evenly spaced
+    values between the bounds of every parameter, or a dict from labels to sequences of values"""
+    if isinstance(levels, dict):
+        axes = [np.asarray(levels[p.label], dtype=float) for p in parameters]
+    else:
+        axes = [np.linspace(p.lower, p.upper, levels) for p in parameters]
+    return np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, len(parameters))
+
+
+class TrialPlan:
+    """The mapped columns of a DataModel, resolved once into per-trial lists
+
+    Symbolic inputs receive a fresh set of slot-values on every trial; empty cells
+    are left out. Numeric inputs are set to nan on empty cells, so that no trial runs
+    on the value of a previous one; the time input must have a value on every trial.
+    Outputs are collected into preallocated arrays, one per column"""
+
+    def __init__(self, model, observations=True):
+        dataframe = model.dataframe
+        self.length = len(dataframe)
+        symbolic = {}
+        self.numeric = []
+        for mapping in model.input_mappings:
+            actrio = mapping.destination
+            name = mapping.source if mapping.rename is None else mapping.rename
+            if isinstance(actrio, basic.SymbolicIO):
+                name = basic.intern(name)
+                values = _column_values(dataframe[mapping.source], True)
+                symbolic.setdefault(actrio, []).append((name, values))
+            elif isinstance(actrio, basic.NumericIO):
+                values = _column_values(dataframe[mapping.source], False)
+                assert actrio is not model.get_input("time") or None not in values, \
+                    "Column '%s' mapped to the time input has empty cells" % mapping.source
+                self.numeric.append((actrio, values))
+        self.symbolic = list(symbolic.items())
+        self.timed = any(actrio is model.get_input("time") for actrio, _ in self.numeric)
+        self.outputs = [(m.source, basic.intern(m.extract), m.destination, isinstance(m.source, basic.SymbolicIO))
+                        for m in model.output_mappings]
+        self.observations = []
+        if observations:
+            grouped = {}
+            for actrio, extract, column, symbolic in self.outputs:
+                if not isinstance(actrio.owner, basic.Module):
+                    # Outputs of the model itself (e.g., rt) are written by run() but have no likelihood
+                    continue
+                values = _column_values(dataframe[column], symbolic)
+                grouped.setdefault(actrio.owner, []).append((actrio, extract, values))
+            self.observations = list(grouped.items())
+
+    def load(self, i):
+        """Sets the inputs to the values of trial i"""
+        for actrio, slots in self.symbolic:
+            actrio.value = {name: values[i] for name, values in slots if values[i] is not None}
+        for actrio, values in self.numeric:
+            value = values[i]
+            actrio.value = np.nan if value is None else value
+
+    def allocate(self):
+        """Returns an empty result array for every output column"""
+        return [np.empty(self.length, dtype=object) if symbolic else np.full(self.length, np.nan)
+                for _, _, _, symbolic in self.outputs]
+
+    def store(self, i, results):
+        """Copies the outputs of trial i into the result arrays"""
+        for (actrio, extract, _, symbolic), values in zip(self.outputs, results):
+            values[i] = actrio.value.get(extract) if symbolic else actrio.value
+
+    def columns(self, results):
+        """Pairs each output column name with its result array, with symbols turned back into values"""
+        return [(column, np.array([basic.extern(v) for v in values], dtype=object) if symbolic else values)
+                for (_, _, column, symbolic), values in zip(self.outputs, results)]
+
+    def log_likelihood(self, i):
+        """Returns the log-likelihood of the observations of trial i, or None if nothing was predicted"""
+        total = None
+        for module, outputs in self.observations:
+            ll = module.log_likelihood([(actrio, extract, values[i]) for actrio, extract, values in outputs])
+            if ll is not None:
+                total = ll if total is None else total + ll
+        return total
+
+    def log_likelihood_gradient(self, i, parameters):
+        """Returns the log-likelihood of the observations of trial i and its gradient with
+        respect to the parameters, or None if nothing was predicted"""
+        total = None
+        gradient = np.zeros(len(parameters))
+        for module, outputs in self.observations:
+            positions = [j for j, p in enumerate(parameters) if p.module is module]
+            result = module.log_likelihood_gradient([(actrio, extract, values[i]) for actrio, extract, values in outputs],
+                                                    [parameters[j].name for j in positions])
+            if result is not None:
+                ll, partial = result
+                total = ll if total is None else total + ll
+                gradient[positions] += partial
+        return None if total is None else (total, gradient)
+
+
+class PrecompiledLikelihood:
+    """The likelihood of a DataModel whose retrievals were recorded once as trace-lag arrays
+
+    Evaluations read the current parameter values of the modules and never replay
+    the trials. The activations of each module are kept for its last decay rate, so
+    consecutive evaluations that only change other parameters share them"""
+
+    def __init__(self, lags):
+        self.lags = lags  # (DeclarativeMemory, TraceLags) pairs
+        self._activations = [(None, None)] * len(lags)  # Per module, the last (decay rate, activations)
+
+    @property
+    def observations(self):
+        return sum(len(lags) for _, lags in self.lags)
+
+    @staticmethod
+    def _values(module):
+        return (module.decay_rate, module.noise, module.threshold, module.latency_factor, module.latency_noise)
+
+    def _module_activations(self, i):
+        module, lags = self.lags[i]
+        decay_rate, activations = self._activations[i]
+        if decay_rate != module.decay_rate:
+            decay_rate, activations = module.decay_rate, lags.activations(module.decay_rate)
+            self._activations[i] = (decay_rate, activations)
+        return activations
+
+    def log_likelihood(self):
+        """Returns the log-likelihood and the number of observations"""
+        total = 0.0
+        for i, (module, lags) in enumerate(self.lags):
+            total += lags.log_likelihood(*self._values(module), activations=self._module_activations(i))[0]
+        return total, self.observations
+
+    def log_likelihood_gradient(self, parameters):
+        """Returns the log-likelihood, its gradient with respect to the parameters and the number of observations"""
+        total = 0.0
+        gradient = np.zeros(len(parameters))
+        for i, (module, lags) in enumerate(self.lags):
+            positions = [j for j, p in enumerate(parameters) if p.module is module]
+            ll, partial = lags.log_likelihood(*self._values(module), [parameters[j].name for j in positions],
+                                              activations=self._module_activations(i))
+            total += ll
+            gradient[positions] += partial
+        return total, gradient, self.observations
+
 
 class DataModel(basic.Model):
     """A specific type of model whose inputs are columns in a Pandas DataFrame"""
@@ -35,7 +430,7 @@ class DataModel(basic.Model):
         assert isinstance(inpt, basic.ActrIO), "Input not ActrIO: %s" % str(inpt)
         assert inpt.direction == basic.Direction.IN
         assert column in self._dataframe.columns, "Column '%s' not in dataframe" % column
-        mapping = basic.DataInputMapping(column, input, rename)
+        mapping = basic.DataInputMapping(column, inpt, rename)
         self._input_mappings.append(mapping)
 
     def connect_output(self, column, outpt, extract=None):
@@ -49,39 +444,335 @@ class DataModel(basic.Model):
         mapping = basic.DataOutputMapping(outpt, column, extract=extract)
         self._output_mappings.append(mapping)
 
-    def fit(self):
-        """A module can use MLE iff all of its mapped outputs have probabilities"""
-        pass
+    def compile(self, observations=True):
+        """Resolves the mapped columns into a trial plan that can be replayed many times"""
+        return TrialPlan(self, observations)
+
+    def _run_trial(self, plan, i):
+        plan.load(i)
+        if plan.timed:
+            self.time = self._time_input.value
+        basic.Model.run(self)
+
+    def log_likelihood(self, plan=None):
+        """Replays all trials analytically and returns the log-likelihood and the number of observations"""
+        if plan is None:
+            plan = self.compile()
+        analytic = [module.analytic for module in self.modules]
+        for module in self.modules:
+            module.analytic = True
+        try:
+            self.reset()
+            total = 0.0
+            observations = 0
+            for i in range(plan.length):
+                self._run_trial(plan, i)
+                ll = plan.log_likelihood(i)
+                if ll is not None:
+                    total += ll
+                    observations += 1
+        finally:
+            for module, value in zip(self.modules, analytic):
+                module.analytic = value
+        return total, observations
+
+    def log_likelihood_gradient(self, parameters, plan=None):
+        """Replays all trials analytically and returns the log-likelihood, its gradient with
+        respect to the parameters and the number of observations"""
+        assert all(p.name in p.module.gradient_parameters for p in parameters), \
+            "No gradient with respect to some of %s" % parameters
+        if plan is None:
+            plan = self.compile()
+        analytic = [module.analytic for module in self.modules]
+        for module in self.modules:
+            module.analytic = True
+        try:
+            self.reset()
+            total = 0.0
+            gradient = np.zeros(len(parameters))
+            observations = 0
+            for i in range(plan.length):
+                self._run_trial(plan, i)
+                result = plan.log_likelihood_gradient(i, parameters)
+                if result is not None:
+                    total += result[0]
+                    gradient += result[1]
+                    observations += 1
+        finally:
+            for module, value in zip(self.modules, analytic):
+                module.analytic = value
+        return total, gradient, observations
+
+    def precompilable(self, parameters=()):
+        """Whether precompile() applies: every observed module is a DeclarativeMemory with exact
+        traces, fed only by the data, and the parameters only change its activations, choices
+        and latencies, so that the trial structure does not depend on them"""
+        observed = set(mapping.source.owner for mapping in self._output_mappings
+                       if isinstance(mapping.source.owner, basic.Module))
+        return (len(self._connections) == 0
+                and all(isinstance(m, DeclarativeMemory) and m.recent_traces is None for m in observed)
+                and all(p.module in observed and p.name in DeclarativeMemory.gradient_parameters
+                        for p in parameters))
+
+    def precompile(self, plan=None):
+        """Replays the trials once and records, for every observed retrieval, the log-lags of
+        the traces of its candidates, so that later evaluations are a few array operations"""
+        if not self.precompilable():
+            raise ValueError("Only models of declarative memories with exact traces fed by the data "
+                             "can be precompiled")
+        if plan is None:
+            plan = self.compile()
+        lags = {module: TraceLags() for module, _ in plan.observations}
+        analytic = [module.analytic for module in self.modules]
+        for module in self.modules:
+            module.analytic = True
+        try:
+            self.reset()
+            for i in range(plan.length):
+                self._run_trial(plan, i)
+                for module, outputs in plan.observations:
+                    lags[module].record(module, [(actrio, extract, values[i]) for actrio, extract, values in outputs])
+        finally:
+            for module, value in zip(self.modules, analytic):
+                module.analytic = value
+        return PrecompiledLikelihood(list(lags.items()))
+
+    def objective(self, parameters, plan=None):
+        """Returns the negative log-likelihood as a function of the parameter values, which also
+        returns its gradient, as expected by scipy.optimize.minimize(..., jac=True)
+
+        plan is a TrialPlan or a PrecompiledLikelihood"""
+        if plan is None:
+            plan = self.compile()
+
+        def objective(x):
+            for parameter, value in zip(parameters, x):
+                parameter.value = value
+            if isinstance(plan, PrecompiledLikelihood):
+                ll, gradient, _ = plan.log_likelihood_gradient(parameters)
+            else:
+                ll, gradient, _ = self.log_likelihood_gradient(parameters, plan)
+            return -ll, -gradient
+
+        return objective
+
+    def fingerprint(self, parameters=()):
+        """Returns a digest of everything the objective depends on besides the values of the free
+        parameters: the data, the column mappings, the modules and their connections, which
+        parameters are free and in which order, and the values of the others"""
+        digest = hashlib.sha1()
+        digest.update(pd.util.hash_pandas_object(self._dataframe, index=False).values.tobytes())
+        digest.update(repr(list(self._dataframe.columns)).encode())
+
+        def where(actrio):
+            # Modules are identified by position, as several may share a name
+            owner = actrio.owner
+            return (self.modules.index(owner) if owner in self.modules else "model", actrio.name)
+
+        free = set((p.module, p.name) for p in parameters)
+        state = [[(p.module.name, self.modules.index(p.module) if p.module in self.modules else None, p.name)
+                  for p in parameters],
+                 [(m.source, where(m.destination), m.rename) for m in self._input_mappings],
+                 [(where(m.source), m.destination, m.extract) for m in self._output_mappings],
+                 [(where(c.source), where(c.destination), c.logic) for c in self._connections]]
+        for module in self.modules:
+            state.append((type(module).__name__, module.name, module.analytic, module.priority,
+                          module.event_driven, getattr(module, "recent_traces", None),
+                          [(name, getattr(module, name)) for name in module.gradient_parameters
+                           if (module, name) not in free]))
+        digest.update(repr(state).encode())
+        return digest.hexdigest()
+
+    def fit(self, parameters, method="bads", options=None, precompile=True, cache=None):
+        """Finds the values of the free parameters that maximize the likelihood of the mapped outputs
+
+        A module can use MLE iff all of its mapped outputs have probabilities.
+        method is either "bads" (PyBADS) or any bounded scipy.optimize.minimize method;
+        gradient-based methods (e.g., "L-BFGS-B") get the closed-form gradient when every
+        parameter has one. Unless precompile is False, models that allow it are replayed
+        only once (see precompile). An EvaluationCache answers repeated evaluations, also
+        across fits; the result reports its hit rate"""
+        assert len(parameters) > 0, "No free parameters"
+        assert all(isinstance(p, Parameter) for p in parameters)
+        assert len(set(p.label for p in parameters)) == len(parameters), "Parameter labels must be unique"
+        assert len(self.output_mappings) > 0, "No output is mapped to the data"
+        if self._profiler is not None:
+            self._profiler.reset()
+        plan = self.compile()
+        compiled = self.precompile(plan) if precompile and self.precompilable(parameters) else None
+        evaluations = 0
+        if cache is not None:
+            fingerprint = self.fingerprint(parameters)
+            hits, misses = cache.hits, cache.misses
+
+        gradient = method in _gradient_methods and all(p.name in p.module.gradient_parameters for p in parameters)
+        value_and_gradient = self.objective(parameters, compiled or plan) if gradient else None
+
+        def evaluate(x):
+            nonlocal evaluations
+            evaluations += 1
+            if gradient:
+                return value_and_gradient(x)
+            for parameter, value in zip(parameters, x):
+                parameter.value = value
+            if compiled is not None:
+                return -compiled.log_likelihood()[0]
+            return -self.log_likelihood(plan)[0]
+
+        def objective(x):
+            if cache is None:
+                return evaluate(x)
+            key = cache.key(fingerprint, x)
+            entry = cache.get(key, gradient)
+            if entry is not None:
+                return entry if gradient else entry[0]
+            result = evaluate(x)
+            if gradient:
+                cache.put(key, *result)
+            else:
+                cache.put(key, result)
+            return result
+
+        x0 = np.array([p.start for p in parameters], dtype=float)
+        lower = np.array([p.lower for p in parameters], dtype=float)
+        upper = np.array([p.upper for p in parameters], dtype=float)
+        if method == "bads":
+            from pybads import BADS
+            result = BADS(objective, x0, lower, upper, options=options).optimize()
+            x, success, message = result["x"], result["success"], result["message"]
+        else:
+            from scipy.optimize import minimize
+            result = minimize(objective, x0, method=method, jac=gradient, bounds=list(zip(lower, upper)),
+                              options=options)
+            x, success, message = result.x, result.success, result.message
+
+        # Leave the modules at the best parameters
+        for parameter, value in zip(parameters, x):
+            parameter.value = value
+        ll, observations = self.log_likelihood(plan)
+        profile = None if self._profiler is None else self._profiler.summary()
+        cache_hits = cache_misses = 0
+        if cache is not None:
+            cache.save()
+            cache_hits, cache_misses = cache.hits - hits, cache.misses - misses
+        return FitResult({p.label: p.value for p in parameters}, ll, observations, evaluations,
+                         success=bool(success), message=str(message), profile=profile,
+                         cache_hits=cache_hits, cache_misses=cache_misses)
+
+    def fit_groups(self, column, parameters, method="bads", options=None, processes=None, seed=None):
+        """Fits every group of rows (e.g., every subject) independently, in a pool of processes
+
+        The model (without its dataframe) is sent once to each worker; each task only
+        carries the rows of its group and its own child of the SeedSequence(seed), so
+        results are reproducible whatever the number of processes.
+        Returns a table with one row per group"""
+        assert column in self._dataframe.columns, "Column '%s' not in dataframe" % column
+        groups = [(key, group) for key, group in self._dataframe.groupby(column, sort=True)]
+        seeds = np.random.SeedSequence(seed).spawn(len(groups))
+        dataframe = self._dataframe
+        self._dataframe = None
+        try:
+            template = pickle.dumps((self, parameters))
+        finally:
+            self._dataframe = dataframe
+
+        if processes == 1:
+            # Fits here, then restores the global numpy state and drops the template
+            state = np.random.get_state()
+            _initialize_worker(template)
+            try:
+                results = [_fit_group(key, group, s, method, options) for (key, group), s in zip(groups, seeds)]
+            finally:
+                _initialize_worker(None)
+                np.random.set_state(state)
+        else:
+            with ProcessPoolExecutor(max_workers=processes,
+                                     initializer=_initialize_worker,
+                                     initargs=(template,)) as pool:
+                futures = [pool.submit(_fit_group, key, group, s, method, options)
+                           for (key, group), s in zip(groups, seeds)]
+                results = [future.result() for future in futures]
+
+        rows = []
+        for key, result in results:
+            rows.append({column: key, **result.parameters,
+                         "log_likelihood": result.log_likelihood, "aic": result.aic, "bic": result.bic,
+                         "observations": result.observations, "evaluations": result.evaluations,
+                         "success": result.success})
+        return pd.DataFrame(rows)
+
+    def sweep(self, parameters, levels=None, samples=None, points=None, processes=None, seed=None,
+              precompile=True):
+        """Evaluates the log-likelihood over a region of parameter space and returns a table with
+        one row per point
+
+        The points are a Cartesian grid (levels, see grid), a Latin hypercube sample (samples,
+        see latin_hypercube) or given as an array with one column per parameter. They are
+        spread over a pool of processes (processes=1 evaluates them here), in contiguous
+        chunks ordered by decay rate, so that precompiled models compute the activations once
+        per decay rate and reuse them for all the other parameters. The parameters are left
+        unchanged"""
+        assert len(parameters) > 0, "No free parameters"
+        assert sum(x is not None for x in (levels, samples, points)) == 1, "Give one of levels, samples or points"
+        if levels is not None:
+            points = grid(parameters, levels)
+        elif samples is not None:
+            points = latin_hypercube(parameters, samples, seed)
+        points = np.asarray(points, dtype=float)
+        assert points.ndim == 2 and points.shape[1] == len(parameters)
+
+        plan = self.compile()
+        if precompile and self.precompilable(parameters):
+            plan = self.precompile(plan)
+        decay = [j for j, p in enumerate(parameters) if p.name == "decay_rate"]
+        order = np.lexsort(points[:, decay].T[::-1]) if decay else np.arange(len(points))
+        start = [p.value for p in parameters]
+        try:
+            template = pickle.dumps((self, parameters, plan))
+        finally:
+            for parameter, value in zip(parameters, start):
+                parameter.value = value
+
+        workers = processes if processes is not None else (os.cpu_count() or 1)
+        chunks = [c for c in np.array_split(order, max(1, min(len(order), 4 * workers))) if len(c) > 0]
+        results = np.empty(len(points))
+        if processes == 1:
+            _initialize_sweep(template)
+            try:
+                for chunk in chunks:
+                    results[chunk] = _sweep_points(points[chunk])
+            finally:
+                _initialize_sweep(None)
+        else:
+            with ProcessPoolExecutor(max_workers=processes,
+                                     initializer=_initialize_sweep,
+                                     initargs=(template,)) as pool:
+                futures = {pool.submit(_sweep_points, points[chunk]): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+
+        table = pd.DataFrame(points, columns=[p.label for p in parameters])
+        table["log_likelihood"] = results
+        return table
 
     def propagate(self):
         """propagate"""
         pass
 
-    def run(self):
-        for index, row in self._dataframe.iterrows():
-            # Set up all the inputs
-            for mapping in self.input_mappings:
-                column = mapping.source
-                actrio = mapping.destination
-                name = column if mapping.rename is None else mapping.rename
-                if isinstance(actrio, basic.SymbolicIO):
-                    actrio.modify({name:str(row[column])})
-                elif isinstance(column, basic.NumericIO):
-                    actrio.value = float(row[column])
-
-            # Now run the model
-            basic.Model.run(self)
-
-            # Now collect the outputs and store them in the desired columns
-            for mapping in self.output_mappings:
-                column = mapping.destination
-                actrio = mapping.source
-                extract = mapping.extract
-                assert isinstance(actrio, basic.ActrIO), "Not a valid IO object: %s" % str(actrio)
-                assert isinstance(column, str), "Not a valid IO object: %s" % str(column)
-                assert isinstance(extract, str), "Not a valid IO object: %s" % str(extract)
-                if isinstance(actrio, basic.SymbolicIO):
-                    row.at[index, column] = actrio.value[extract]
-                elif isinstance(column, basic.NumericIO):
-                    row.at[index, column] = actrio.value
+    def run(self, reset=True):
+        """Runs the model on every row, from its initial state, and returns its predictions
 
+        The predictions are a new DataFrame, with the index of the data and one column per
+        mapped output; the data itself is left untouched. With reset=False, the run continues
+        from the current state instead (e.g., a fork after a shared study phase). If the
+        model has a profiler, its summary covers this run"""
+        if self._profiler is not None:
+            self._profiler.reset()
+        if reset:
+            self.reset()
+        plan = self.compile(observations=False)
+        results = plan.allocate()
+        for i in range(plan.length):
+            self._run_trial(plan, i)
+            plan.store(i, results)
+        return pd.DataFrame(dict(plan.columns(results)), index=self._dataframe.index)
@@ -1,28 +1,242 @@
-from copy import copy
+import copy
 import numpy as np
 from numbers import Number
-from actrme.basic import SymbolicIO, NumericIO, Direction, boltzmann, TimeKeeper, Module
+from actrme.basic import SymbolicIO, NumericIO, Direction, boltzmann, TimeKeeper, Module, Chunk, make_chunk, extern, lookup_items, EventType
 import actrme.basic
-from random import choices
+from bisect import insort
+from collections import namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "size"])
+
+RetrievalDistribution = namedtuple("RetrievalDistribution",
+                                   ["memories", "activations", "probabilities", "latencies",
+                                    "failure_probability", "failure_latency", "expected_latency"])
+BatchRetrieval = namedtuple("BatchRetrieval", ["ids", "chunks", "latencies", "probabilities"])
+BatchRetrieval.__doc__ = """The outcome of one retrieval for every agent of a batch: the id of the
+retrieved memory (-1 for a failure), its contents (None for a failure), the
+retrieval time and the retrieval probability of the retrieved memory (nan for a failure)"""
+
+RetrievalDistribution.__doc__ = """The predicted outcome of a retrieval: the candidate memories with their
+activations, choice probabilities and latencies, the probability and latency of
+a retrieval failure, and the expected latency over all outcomes"""
+
+
+class TraceStore:
+    """Contiguous arrays of (chunk id, trace time) pairs shared by all the memories of a module"""
+
+    def __init__(self, capacity=64):
+        assert capacity > 0
+        self._chunks = np.empty(capacity, dtype=np.intp)
+        self._times = np.empty(capacity, dtype=float)
+        self._created = np.empty(capacity, dtype=float)
+        self._counts = np.empty(capacity, dtype=np.intp)
+        self._size = 0
+        self._nchunks = 0
+        self._shared = False  # Whether the arrays are shared with a fork
+
+    def __len__(self):
+        return self._size
+
+    def fork(self):
+        """Returns a copy that shares the arrays until either copy is modified"""
+        other = TraceStore.__new__(TraceStore)
+        other._chunks, other._times, other._created = self._chunks, self._times, self._created
+        other._counts = self._counts
+        other._size, other._nchunks = self._size, self._nchunks
+        self._shared = other._shared = True
+        return other
+
+    def _own(self):
+        if self._shared:
+            self._chunks = self._chunks.copy()
+            self._times = self._times.copy()
+            self._created = self._created.copy()
+            self._counts = self._counts.copy()
+            self._shared = False
+
+    @property
+    def chunks(self):
+        """The chunk id of each trace"""
+        return self._chunks[:self._size]
+
+    @property
+    def times(self):
+        """The time of each trace"""
+        return self._times[:self._size]
+
+    @property
+    def creation_times(self):
+        """The time of the earliest trace of each chunk id (inf for removed chunks)"""
+        return self._created[:self._nchunks]
+
+    def count(self, chunk):
+        """Returns the number of traces of a chunk id"""
+        return int(self._counts[chunk]) if chunk < self._nchunks else 0
+
+    def _grow(self):
+        capacity = 2 * len(self._times)
+        chunks = np.empty(capacity, dtype=np.intp)
+        times = np.empty(capacity, dtype=float)
+        chunks[:self._size] = self.chunks
+        times[:self._size] = self.times
+        self._chunks = chunks
+        self._times = times
+
+    def add(self, chunk, time):
+        """Adds a trace of a chunk at a certain time"""
+        assert chunk >= 0
+        self._own()
+        if self._size == len(self._times):
+            self._grow()
+        self._chunks[self._size] = chunk
+        self._times[self._size] = time
+        self._size += 1
+        self.register(chunk, time)
+        self._counts[chunk] += 1
+
+    def register(self, chunk, time):
+        """Records a presentation of a chunk for its creation time without storing the trace"""
+        self._own()
+        if chunk >= self._nchunks:
+            if chunk >= len(self._created):
+                capacity = max(2 * len(self._created), chunk + 1)
+                created = np.empty(capacity, dtype=float)
+                created[:self._nchunks] = self.creation_times
+                counts = np.empty(capacity, dtype=np.intp)
+                counts[:self._nchunks] = self._counts[:self._nchunks]
+                self._created = created
+                self._counts = counts
+            self._created[self._nchunks:chunk + 1] = np.inf
+            self._counts[self._nchunks:chunk + 1] = 0
+            self._nchunks = chunk + 1
+        if time < self._created[chunk]:
+            self._created[chunk] = time
+
+    def remove(self, chunk, time):
+        """Removes one trace of a chunk at a certain time"""
+        matches = np.flatnonzero((self.chunks == chunk) & (self.times == time))
+        assert len(matches) > 0, "No trace of chunk %d at time %s" % (chunk, time)
+        self._own()
+        i = matches[0]
+        self._chunks[i:self._size - 1] = self._chunks[i + 1:self._size]
+        self._times[i:self._size - 1] = self._times[i + 1:self._size]
+        self._size -= 1
+        self._counts[chunk] -= 1
+
+    def remove_chunk(self, chunk):
+        """Removes all the traces of a chunk"""
+        self._own()
+        keep = self.chunks != chunk
+        n = int(keep.sum())
+        self._chunks[:n] = self.chunks[keep]
+        self._times[:n] = self.times[keep]
+        self._size = n
+        if chunk < self._nchunks:
+            self._created[chunk] = np.inf
+            self._counts[chunk] = 0
+
+    def clear(self):
+        if self._shared:
+            self.__init__()
+        self._size = 0
+        self._nchunks = 0
+
+    def activation_gradients(self, time, decay_rate, chunks):
+        """Returns the derivatives of the activations of the given chunk ids with respect to the decay rate
+
+        dA/dd = -sum(t^-d log t) / sum(t^-d), over the past traces of each chunk"""
+        lags = time - self.times
+        past = lags > 0
+        lags = lags[past]
+        powers = np.power(lags, -decay_rate)
+        odds = np.bincount(self.chunks[past], weights=powers, minlength=self._nchunks)
+        weighted = np.bincount(self.chunks[past], weights=powers * np.log(lags), minlength=self._nchunks)
+        chunks = np.asarray(chunks, dtype=np.intp)
+        odds, weighted = odds[chunks], weighted[chunks]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(odds > 0, -weighted / odds, 0.0)
+
+    def activations(self, time, decay_rate, chunks=None):
+        """Returns the base-level activations at time t of all chunks, or only of the given chunk ids"""
+        lags = time - self.times
+        past = lags > 0
+        odds = np.bincount(self.chunks[past],
+                           weights=np.power(lags[past], -decay_rate),
+                           minlength=self._nchunks)
+        if chunks is not None:
+            odds = odds[np.asarray(chunks, dtype=np.intp)]
+        with np.errstate(divide="ignore"):
+            activations = np.log(odds)
+        activations[odds <= 0] = np.nan
+        return activations
+
+
+def chunk_key(contents):
+    """Returns the canonical, hashable key of the slot-value pairs of a chunk: the immutable chunk itself"""
+    return make_chunk(contents)
+
 
 class Memory:
-    """An internal representation of a memory (or "chunk" in ACT-R lingo)"""
+    """An internal representation of a memory (or "chunk" in ACT-R lingo)
 
-    def __init__(self, creation_time=0.0, contents={}, decay_rate=0.5):
-        assert isinstance(contents, dict)
-        self._contents = copy(contents)
+    The contents are an immutable Chunk, shared rather than copied. A memory of a
+    DeclarativeMemory takes its decay rate from the module, and its traces go through
+    the module; in exact mode they are only kept in the trace store of the module"""
+    __slots__ = ("_contents", "_traces", "_decay_rate", "_recent_traces",
+                 "_old_traces", "_first_trace", "_id", "_owner")
+
+    def __init__(self, creation_time=0.0, contents={}, decay_rate=0.5, recent_traces=None):
+        assert isinstance(contents, (dict, Chunk))
+        assert recent_traces is None or recent_traces >= 1
+        self._contents = make_chunk(contents)
         self._traces = [creation_time]
         self._decay_rate = decay_rate
+        self._recent_traces = recent_traces
+        self._old_traces = 0  # Traces summarized by the hybrid approximation
+        self._first_trace = creation_time
+        self._id = None
+        self._owner = None  # The DeclarativeMemory of the memory
+
+    def clone(self):
+        """Returns a copy of the memory with its own traces"""
+        other = Memory.__new__(Memory)
+        other._contents = self._contents
+        other._traces = None if self._traces is None else list(self._traces)
+        other._decay_rate = self._decay_rate
+        other._recent_traces = self._recent_traces
+        other._old_traces = self._old_traces
+        other._first_trace = self._first_trace
+        other._id = self._id
+        other._owner = self._owner
+        return other
 
     def creation_time(self):
+        if self._traces is None:
+            return self._owner._traces.creation_times[self._id]
+        if self._old_traces > 0:
+            return self._first_trace
         return np.min(self._traces)
 
+    @property
+    def recent_traces(self):
+        """Number of recent traces kept exactly (None keeps every trace)"""
+        return self._recent_traces
+
+    def trace_count(self):
+        """Total number of presentations, including summarized ones"""
+        if self._traces is None:
+            return self._owner._traces.count(self._id)
+        return len(self._traces) + self._old_traces
+
     @property
     def decay_rate(self):
+        if self._owner is not None:
+            return self._owner.decay_rate
         return self._decay_rate
 
     @decay_rate.setter
     def decay_rate(self, value):
+        assert self._owner is None, "The decay rate of a memory of a module is the one of the module"
         self._decay_rate = value
 
     @property
@@ -32,36 +246,121 @@ class Memory:
     @contents.setter
     def contents(self, contents):
         """Sets the content of a memory"""
-        assert type(contents) == dict
-        self._contents = copy(contents)
+        assert isinstance(contents, (dict, Chunk))
+        self._contents = make_chunk(contents)
+
+    @property
+    def schema(self):
+        return self._contents.schema
+
+    def get(self, slot, default=None):
+        """Returns the value of a slot"""
+        return self._contents.get(slot, default)
 
     def add_trace(self, time):
         """Add a trace to the current memory
         :type time: Number
         """
         assert isinstance(time, Number)
-        self._traces.append(time)
+        if self._owner is not None:
+            self._owner.add_trace(self, time)
+        else:
+            self._add_trace(time)
+
+    def _add_trace(self, time):
+        if self._recent_traces is None:
+            self._traces.append(time)
+            return
+        insort(self._traces, time)
+        if len(self._traces) > self._recent_traces:
+            oldest = self._traces.pop(0)
+            if self._old_traces == 0:
+                self._first_trace = oldest
+            self._old_traces += 1
 
     def remove_trace(self, time):
-        """Removes a trace from the memory"""
+        """Removes a trace from the memory (only recent traces can be removed in approximate mode)"""
         assert isinstance(time, Number)
-        assert time in self._traces
-        self._traces.remove(time)
+        if self._owner is not None:
+            self._owner.remove_trace(self, time)
+        else:
+            assert time in self._traces
+            self._traces.remove(time)
 
     def activation(self, time):
-        """Computes the activation of a memory at a certain time t"""
+        """Computes the activation of a memory at a certain time t
+
+        In approximate mode, the traces older than the most recent ones are assumed
+        to be evenly spread between the first and the oldest recent trace, and their
+        contribution is summarized in closed form (Petrov, 2006)"""
         assert isinstance(time, Number)
-        odds = 0.0
-        for t_i in self._traces:
-            if t_i < time:
-                odds += (time - t_i) ** (-self.decay_rate)
+        if self._traces is None:
+            return self._owner._traces.activations(time, self._owner.decay_rate, [self._id])[0]
+        d = self.decay_rate
+        lags = time - np.asarray(self._traces, dtype=float)
+        odds = np.power(lags[lags > 0], -d).sum()
+        if self._old_traces > 0:
+            t_n = time - self._first_trace
+            t_k = time - self._traces[0]
+            if t_k <= 0:
+                pass
+            elif t_n <= t_k:
+                odds += self._old_traces * t_n ** -d
+            elif d == 1:
+                odds += self._old_traces * (np.log(t_n) - np.log(t_k)) / (t_n - t_k)
+            else:
+                odds += self._old_traces * (t_n ** (1 - d) - t_k ** (1 - d)) / ((1 - d) * (t_n - t_k))
         if odds > 0:
             return np.log(odds)
         else:
             return np.nan
 
+    def activation_gradient(self, time):
+        """Computes the derivative of the activation at time t with respect to the decay rate"""
+        assert isinstance(time, Number)
+        if self._traces is None:
+            return self._owner._traces.activation_gradients(time, self._owner.decay_rate, [self._id])[0]
+        d = self.decay_rate
+        lags = time - np.asarray(self._traces, dtype=float)
+        lags = lags[lags > 0]
+        odds = np.power(lags, -d).sum()
+        weighted = -(np.power(lags, -d) * np.log(lags)).sum()  # d(odds)/dd
+        if self._old_traces > 0:
+            n = self._old_traces
+            t_n = time - self._first_trace
+            t_k = time - self._traces[0]
+            if t_k <= 0:
+                pass
+            elif t_n <= t_k:
+                odds += n * t_n ** -d
+                weighted -= n * t_n ** -d * np.log(t_n)
+            elif d == 1:
+                odds += n * (np.log(t_n) - np.log(t_k)) / (t_n - t_k)
+                weighted -= n * (np.log(t_n) ** 2 - np.log(t_k) ** 2) / (2 * (t_n - t_k))
+            else:
+                u_n, u_k = t_n ** (1 - d), t_k ** (1 - d)
+                odds += n * (u_n - u_k) / ((1 - d) * (t_n - t_k))
+                weighted += n * ((u_n - u_k) / (1 - d) - (u_n * np.log(t_n) - u_k * np.log(t_k))) \
+                    / ((1 - d) * (t_n - t_k))
+        if odds > 0:
+            return weighted / odds
+        else:
+            return 0.0
+
     def __repr__(self):
-        return "<Memory [%d] %s>" % (len(self._traces), self._contents)
+        return "<Memory [%d] %s>" % (self.trace_count(), self.contents)
+
+
+def approximation_error(traces, time, decay_rate=0.5, recent_traces=1):
+    """Returns the difference between the approximate and the exact activation of a
+    memory presented at the given times"""
+    assert len(traces) > 0
+    exact = Memory(creation_time=traces[0], decay_rate=decay_rate)
+    approximate = Memory(creation_time=traces[0], decay_rate=decay_rate, recent_traces=recent_traces)
+    for t in traces[1:]:
+        exact.add_trace(t)
+        approximate.add_trace(t)
+    return approximate.activation(time) - exact.activation(time)
 
 
 class DeclarativeMemory(actrme.basic.Module, TimeKeeper):
@@ -70,14 +369,27 @@ class DeclarativeMemory(actrme.basic.Module, TimeKeeper):
     def __init__(self):
         TimeKeeper.__init__(self)
         Module.__init__(self, name="Declarative Memory")
-        #print(self.inputs)
-        self._memories = []
+        self._chunks = []  # Memories by id; removed memories leave a None
+        self._index = {}  # chunk_key -> Memory, in order of creation
+        self._postings = {}  # (slot, value) -> set of memory ids
+        self._traces = TraceStore()
+        self._cache = {}  # memory id -> (time, decay rate, activation)
+        self._cache_hits = 0
+        self._cache_misses = 0
+        # After a fork, the ids of the memories and the posting keys this copy may modify in
+        # place; the others are shared with other copies and copied on their first change.
+        # None when nothing is shared
+        self._owned = None
+        self._owned_postings = None
         self._model = None
         self._noise = 0.2
         self._decay_rate = 0.5
+        self._recent_traces = None
         self._threshold = 0
         self._latency_factor = 1.0
+        self._latency_noise = 0.3
         self._encode_on_retrieval = True
+        self._distribution = None
         self._encode = SymbolicIO(name="encode", direction = Direction.IN, owner=self)
         self._cue = SymbolicIO(name="cue", direction = Direction.IN, owner=self)
         self._retrieval = SymbolicIO(name="retrieval", direction=Direction.OUT, owner=self)
@@ -99,6 +411,27 @@ class DeclarativeMemory(actrme.basic.Module, TimeKeeper):
         assert value > 0
         self._noise = value
 
+    @property
+    def decay_rate(self):
+        return self._decay_rate
+
+    @decay_rate.setter
+    def decay_rate(self, value):
+        assert isinstance(value, Number)
+        assert value > 0
+        self._decay_rate = value
+
+    @property
+    def recent_traces(self):
+        """Number of recent traces per memory kept exactly (None for exact base-level learning)"""
+        return self._recent_traces
+
+    @recent_traces.setter
+    def recent_traces(self, value):
+        assert value is None or (isinstance(value, int) and value >= 1)
+        assert len(self._index) == 0, "Cannot change the trace mode of a non-empty memory"
+        self._recent_traces = value
+
     @property
     def threshold(self):
         return self._threshold
@@ -117,6 +450,17 @@ class DeclarativeMemory(actrme.basic.Module, TimeKeeper):
         assert isinstance(value, Number)
         self._latency_factor = value
 
+    @property
+    def latency_noise(self):
+        """Standard deviation of the log-normal distribution of observed retrieval times"""
+        return self._latency_noise
+
+    @latency_noise.setter
+    def latency_noise(self, value):
+        assert isinstance(value, Number)
+        assert value > 0
+        self._latency_noise = value
+
     @property
     def encode_on_retrieval(self):
         return self._encode_on_retrieval
@@ -126,73 +470,866 @@ class DeclarativeMemory(actrme.basic.Module, TimeKeeper):
         assert isinstance(value, bool)
         self._encode_on_retrieval = value
 
+    def _compute_activations(self, memories, time):
+        if self._recent_traces is not None:
+            if memories is None:
+                return np.array([np.nan if m is None else m.activation(time) for m in self._chunks], dtype=float)
+            return np.array([m.activation(time) for m in memories], dtype=float)
+        chunks = None if memories is None else [m._id for m in memories]
+        return self._traces.activations(time, self.decay_rate, chunks)
+
+    @property
+    def distribution(self):
+        """The distribution predicted by the last analytic retrieval"""
+        return self._distribution
+
+    def activations(self, memories=None, time=None):
+        """Computes the activations of all memories (or of a subset) at time t in one vectorized pass
+
+        Activations of a subset are cached per memory until the memory gets a new trace,
+        the time moves or the decay rate changes"""
+        if time is None:
+            time = self.time
+        if memories is None:
+            return self._compute_activations(None, time)
+        d = self.decay_rate
+        activations = np.empty(len(memories), dtype=float)
+        missing = []
+        for i, m in enumerate(memories):
+            entry = self._cache.get(m._id)
+            if entry is not None and entry[0] == time and entry[1] == d:
+                activations[i] = entry[2]
+            else:
+                missing.append(i)
+        self._cache_hits += len(memories) - len(missing)
+        self._cache_misses += len(missing)
+        if len(missing) > 0:
+            computed = self._compute_activations([memories[i] for i in missing], time)
+            for i, A in zip(missing, computed):
+                activations[i] = A
+                self._cache[memories[i]._id] = (time, d, A)
+        return activations
+
+    def activation_gradients(self, memories, time=None):
+        """Computes the derivatives of the activations of memories with respect to the decay rate"""
+        if time is None:
+            time = self.time
+        if self._recent_traces is not None:
+            return np.array([m.activation_gradient(time) for m in memories], dtype=float)
+        return self._traces.activation_gradients(time, self.decay_rate, [m._id for m in memories])
+
+    def activation(self, memory):
+        """Computes the activation of a memory at the current time"""
+        assert isinstance(memory, Memory)
+        assert memory._id is not None and self._chunks[memory._id] is memory, "Memory not in module: %s" % memory
+        return self.activations([memory])[0]
+
+    def cache_info(self):
+        """Returns the hits, misses and current size of the activation cache"""
+        return CacheInfo(self._cache_hits, self._cache_misses, len(self._cache))
+
+    def clear_cache(self):
+        """Empties the activation cache and resets its counters"""
+        self._cache = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+
     def retrieval_probability(self, memory):
         """Computes the probability of a memory at a certain time t"""
-        assert isinstance(memory, Memory)
-        assert memory in self._memories
-        A = memory.activation(self.time)
+        A = self.activation(memory)
         T = self.threshold
         s = self.noise
         return 1 / (1 + np.exp((-A + T)/s))
 
     def retrieval_time(self, memory):
         """Computes the time of a memory at a certain time t"""
-        assert isinstance(memory, Memory)
-        assert memory in self._memories
-        A = memory.activation(self.time)
+        A = self.activation(memory)
         T = self.threshold
         F = self.latency_factor
         s = self.noise
         return np.exp(F * (-A + T)/s)
 
+    def conflict_set(self, cue):
+        """Returns the memories that match a cue and were created before the current time"""
+        ids = self.matching(cue)
+        ids = ids[self._traces.creation_times[ids] < self.time]
+        if self._profiler is not None:
+            self._profiler.conflict_set(len(ids))
+        if self._owned is not None:
+            return [self._writable(self._chunks[i]) for i in ids]
+        return [self._chunks[i] for i in ids]
+
+    def retrieval_distribution(self, cue):
+        """Computes the probability and latency of every possible outcome of retrieving a cue
+
+        The threshold competes with the candidates in the Boltzmann choice rule, so
+        that p(i) = exp(A_i/s) / (sum_j exp(A_j/s) + exp(T/s)) and the remaining
+        mass is the probability of a retrieval failure"""
+        memories = self.conflict_set(cue)
+        A = self.activations(memories)
+        T = self.threshold
+        F = self.latency_factor
+        s = self.noise
+        z = np.append(np.where(np.isnan(A), -np.inf, A), T) / s
+        weights = np.exp(z - np.max(z))
+        weights /= weights.sum()
+        latencies = np.exp(F * (-A + T) / s)
+        failure_latency = np.exp(F * (-T) / s)
+        p = weights[:-1]
+        expected = np.dot(p[p > 0], latencies[p > 0]) + weights[-1] * failure_latency
+        return RetrievalDistribution(memories, A, p, latencies, weights[-1], failure_latency, expected)
+
     def reset(self):
-        self._memories = []
+        self._chunks = []
+        self._index = {}
+        self._postings = {}
+        self._cache = {}
+        self._owned = None
+        self._owned_postings = None
+        self._distribution = None
+        self._traces.clear()
         self.time = 0
 
+    def _writable(self, memory):
+        """Returns the memory, or this copy's own clone of it if it is shared with a fork
+
+        In exact mode memories hold no traces, so a copy only needs its own clone of
+        the memories of another copy"""
+        if self._recent_traces is None:
+            if memory._owner is self:
+                return memory
+        elif self._owned is None or memory._id in self._owned:
+            return memory
+        clone = memory.clone()
+        clone._owner = self
+        self._chunks[clone._id] = clone
+        self._index[clone.contents] = clone
+        if self._owned is not None:
+            self._owned.add(clone._id)
+        return clone
+
+    def _writable_posting(self, item):
+        """Returns the (possibly new) posting of a slot-value, copied first if it is shared with a fork"""
+        posting = self._postings.get(item)
+        if posting is None:
+            posting = self._postings[item] = set()
+            if self._owned_postings is not None:
+                self._owned_postings.add(item)
+        elif self._owned_postings is not None and item not in self._owned_postings:
+            posting = self._postings[item] = set(posting)
+            self._owned_postings.add(item)
+        return posting
+
+    def fork(self):
+        """Returns an independent copy of the memory that continues from its current state
+
+        The copies share their history: the trace arrays, the memories and the index
+        postings are copied by either copy only when it first changes them, so a fork
+        costs a shallow copy of the index and each branch pays for its own divergence"""
+        memo = {id(self._traces): self._traces.fork(),
+                id(self._chunks): list(self._chunks),
+                id(self._index): dict(self._index),
+                id(self._postings): dict(self._postings),
+                id(self._cache): dict(self._cache),
+                id(self._distribution): self._distribution,
+                id(self._model): None, id(self._tracer): self._tracer, id(self._profiler): self._profiler}
+        other = copy.deepcopy(self, memo)
+        self._owned, self._owned_postings = set(), set()
+        other._owned, other._owned_postings = set(), set()
+        return other
+
+    def state(self):
+        """Returns the state of the module (parameters, memories, traces, time and IO values)
+
+        Chunks are kept as a list by id and traces as flat arrays"""
+        state = Module.state(self)
+        chunks = [None if m is None else m.contents for m in self._chunks]
+        live = [m for m in self._chunks if m is not None]
+        state.update({
+            "parameters": {"noise": self._noise, "decay_rate": self._decay_rate,
+                           "recent_traces": self._recent_traces, "threshold": self._threshold,
+                           "latency_factor": self._latency_factor, "latency_noise": self._latency_noise,
+                           "encode_on_retrieval": self._encode_on_retrieval},
+            "chunks": chunks,
+            "trace chunks": self._traces.chunks.copy(),
+            "trace times": self._traces.times.copy(),
+            "creation times": self._traces.creation_times.copy()})
+        if self._recent_traces is not None:
+            # The exact traces of the hybrid approximation are not kept in the trace store
+            state["memory traces"] = np.array([t for m in live for t in m._traces], dtype=float)
+            state["memory trace counts"] = np.array([len(m._traces) for m in live], dtype=np.intp)
+            state["old traces"] = np.array([m._old_traces for m in live], dtype=np.intp)
+            state["first traces"] = np.array([m._first_trace for m in live], dtype=float)
+        return state
+
+    def set_state(self, state):
+        parameters = state["parameters"]
+        self._noise = parameters["noise"]
+        self._decay_rate = parameters["decay_rate"]
+        self._recent_traces = parameters["recent_traces"]
+        self._threshold = parameters["threshold"]
+        self._latency_factor = parameters["latency_factor"]
+        self._latency_noise = parameters["latency_noise"]
+        self._encode_on_retrieval = parameters["encode_on_retrieval"]
+        self.reset()
+        Module.set_state(self, state)
+        store = TraceStore(max(1, len(state["trace times"])))
+        store._size = len(state["trace times"])
+        store._chunks[:store._size] = state["trace chunks"]
+        store._times[:store._size] = state["trace times"]
+        store._nchunks = len(state["creation times"])
+        store._created = np.array(state["creation times"], dtype=float)
+        store._counts = np.bincount(store.chunks, minlength=store._nchunks).astype(np.intp)
+        self._traces = store
+        if self._recent_traces is not None:
+            counts = state["memory trace counts"]
+            traces = iter(np.split(state["memory traces"], np.cumsum(counts)[:-1]))
+            old = iter(state["old traces"])
+            first = iter(state["first traces"])
+        for i, contents in enumerate(state["chunks"]):
+            if contents is None:
+                self._chunks.append(None)
+                continue
+            m = Memory.__new__(Memory)
+            m._contents = contents
+            m._decay_rate = self._decay_rate
+            m._recent_traces = self._recent_traces
+            m._id = i
+            m._owner = self
+            if self._recent_traces is None:
+                m._traces = None
+                m._old_traces = 0
+                m._first_trace = store.creation_times[i]
+            else:
+                m._traces = next(traces).tolist()
+                m._old_traces = int(next(old))
+                m._first_trace = float(next(first))
+            self._chunks.append(m)
+            self._index[contents] = m
+            for item in contents.interned_items():
+                self._postings.setdefault(item, set()).add(i)
+
+    def get_memory(self, contents):
+        """Returns the memory with exactly these contents, or None"""
+        assert isinstance(contents, (dict, Chunk))
+        m = self._index.get(chunk_key(contents))
+        if m is None or self._owned is None:
+            return m
+        return self._writable(m)
+
+    def add_trace(self, memory, time):
+        """Adds a trace of a memory of the module at a certain time and returns the memory"""
+        assert isinstance(time, Number)
+        assert memory._id is not None and self._chunks[memory._id] is memory, "Memory not in module: %s" % memory
+        if self._recent_traces is None:
+            self._traces.add(memory._id, time)
+        else:
+            memory = self._writable(memory)
+            memory._add_trace(time)
+            self._traces.register(memory._id, time)
+        self._cache.pop(memory._id, None)
+        return memory
+
+    def remove_trace(self, memory, time):
+        """Removes a trace of a memory of the module at a certain time"""
+        assert isinstance(time, Number)
+        assert memory._id is not None and self._chunks[memory._id] is memory, "Memory not in module: %s" % memory
+        if self._recent_traces is None:
+            self._traces.remove(memory._id, time)
+        else:
+            memory = self._writable(memory)
+            assert time in memory._traces
+            memory._traces.remove(time)
+        self._cache.pop(memory._id, None)
+
+    def remove(self, memory):
+        """Removes a memory and all of its traces"""
+        assert isinstance(memory, Memory)
+        assert self._index.get(chunk_key(memory.contents)) is memory, "Memory not in module: %s" % memory
+        del self._index[chunk_key(memory.contents)]
+        self._chunks[memory._id] = None
+        for item in memory.contents.interned_items():
+            posting = self._writable_posting(item)
+            posting.discard(memory._id)
+            if len(posting) == 0:
+                del self._postings[item]
+        if memory._owner is self:
+            # The memory keeps its traces and decay rate outside of the module
+            if memory._traces is None:
+                memory._traces = self._traces.times[self._traces.chunks == memory._id].tolist()
+            memory._decay_rate = self.decay_rate
+            memory._owner = None
+        self._traces.remove_chunk(memory._id)
+        self._cache.pop(memory._id, None)
+
+    def matching(self, cue):
+        """Returns the sorted ids of the memories whose contents include all the slot-values of the cue"""
+        assert isinstance(cue, (dict, Chunk))
+        if len(cue) == 0:
+            return np.array(sorted(m._id for m in self._index.values()), dtype=np.intp)
+        postings = []
+        for item in lookup_items(cue):
+            posting = self._postings.get(item)
+            if posting is None:
+                return np.empty(0, dtype=np.intp)
+            postings.append(posting)
+        postings.sort(key=len)
+        ids = postings[0].intersection(*postings[1:])
+        return np.array(sorted(ids), dtype=np.intp)
+
     def encode(self, contents):
         """Adds a trace to an existing memory or encodes a new one"""
-        assert isinstance(contents, dict)
-        all_contents = [m.contents for m in self._memories]
-        if contents in all_contents:
-            ii = all_contents.index(contents)
-            self._memories[ii].add_trace(time=self.time)
+        assert isinstance(contents, (dict, Chunk))
+        key = chunk_key(contents)
+        m = self._index.get(key)
+        if m is not None:
+            m = self.add_trace(m, self.time)
         else:
             m = Memory(creation_time=self.time,
-                       contents=contents)
-            print(m)
-            self._memories.append(m)
-
+                       contents=key,
+                       decay_rate=self.decay_rate,
+                       recent_traces=self._recent_traces)
+            m._id = len(self._chunks)
+            m._owner = self
+            self._chunks.append(m)
+            self._index[key] = m
+            if self._owned is not None:
+                self._owned.add(m._id)
+            for item in key.interned_items():
+                self._writable_posting(item).add(m._id)
+            if self._recent_traces is None:
+                m._traces = None
+                self._traces.add(m._id, self.time)
+            else:
+                self._traces.register(m._id, self.time)
+        if self._tracer is not None:
+            self._tracer.record(EventType.ENCODE, self.time, self, key, m.trace_count())
 
     def retrieve(self, cue):
         """Retrieves the best matching memory"""
-        assert isinstance(cue, dict)
-        conflict_set = []
-        for m in self._memories:
-            if m.creation_time() < self.time and cue.items() <= m.contents.items():
-                conflict_set.append(m)
+        assert isinstance(cue, (dict, Chunk))
+        if self._analytic:
+            return self._retrieve_analytic(cue)
+        conflict_set = self.conflict_set(cue)
 
         if len(conflict_set) > 0:
-            weights = boltzmann([x.activation(self.time) for x in conflict_set], self.noise)
-            target = choices(conflict_set, weights=weights, k=1)[0]
-            self._retrieval.value = copy(target.contents)
+            weights = np.cumsum(boltzmann(self.activations(conflict_set), self.noise))
+            i = int(np.searchsorted(weights, self.uniform() * weights[-1], side="right"))
+            target = conflict_set[min(i, len(conflict_set) - 1)]
+            self._retrieval.value = target.contents
             self._rt.value = self.retrieval_time(target)
             self._retrieval_probability.value = self.retrieval_probability(target)
-            print(target)
+            if self._tracer is not None:
+                self._tracer.record(EventType.RETRIEVE, self.time, self, target.contents, self._rt.value)
+            if self._profiler is not None:
+                self._profiler.retrieval(False)
             return target
         else:
             T = self.threshold
             F = self.latency_factor
             s = self.noise
             self._retrieval.value = {}
-            self._retrieval.value = {}
             self._rt.value = np.exp(F * (-T) / s)
+            if self._tracer is not None:
+                self._tracer.record(EventType.FAILURE, self.time, self, cue, self._rt.value)
+            if self._profiler is not None:
+                self._profiler.retrieval(True)
             return None
 
+    def _retrieve_analytic(self, cue):
+        """Stores the retrieval distribution and outputs its most likely outcome with the expected latency"""
+        distribution = self.retrieval_distribution(cue)
+        self._distribution = distribution
+        self._rt.value = distribution.expected_latency
+        p = distribution.probabilities
+        if len(p) > 0 and p.max() > distribution.failure_probability:
+            i = int(np.argmax(p))
+            target = distribution.memories[i]
+            self._retrieval.value = target.contents
+            self._retrieval_probability.value = p[i]
+            if self._tracer is not None:
+                self._tracer.record(EventType.RETRIEVE, self.time, self, target.contents, self._rt.value)
+            if self._profiler is not None:
+                self._profiler.retrieval(False)
+            return target
+        self._retrieval.value = {}
+        self._retrieval_probability.value = distribution.failure_probability
+        if self._tracer is not None:
+            self._tracer.record(EventType.FAILURE, self.time, self, cue, self._rt.value)
+        if self._profiler is not None:
+            self._profiler.retrieval(True)
+        return None
+
     def run(self):
-        if self._encode.value is not {}:
+        self._distribution = None
+        if len(self._encode.value) > 0:
             self.encode(self._encode.value)
 
-        if self._cue.value is not {}:
+        if len(self._cue.value) > 0:
             self.retrieve(self._cue.value)
+        else:
+            self._retrieval.value = {}
+            self._rt.value = np.nan
+            self._retrieval_probability.value = np.nan
         ## Should always return duration
         return 0.0
+
+    gradient_parameters = ("decay_rate", "noise", "threshold", "latency_factor", "latency_noise")
+
+    def log_likelihood(self, observations):
+        """Computes the log-likelihood of an observed retrieval and retrieval time
+
+        A response that matches no candidate is attributed to a retrieval failure.
+        Retrieval times are log-normally distributed around the latency of each
+        outcome; when both are observed, the likelihood is the joint one"""
+        result = self._likelihood(observations)
+        return None if result is None else result[0]
+
+    def log_likelihood_gradient(self, observations, parameters):
+        """Computes the log-likelihood of an observed retrieval and retrieval time and its
+        closed-form gradient with respect to the named parameters"""
+        return self._likelihood(observations, parameters)
+
+    def _likelihood(self, observations, parameters=None):
+        distribution = self._distribution
+        if distribution is None:
+            return None
+        p = np.append(distribution.probabilities, distribution.failure_probability)
+        latencies = np.append(distribution.latencies, distribution.failure_latency)
+        observed = False
+        rt = None
+        for output, extract, value in observations:
+            if value is None:
+                continue
+            if output is self._retrieval:
+                value = extern(value)
+                match = np.array([m.get(extract) == value for m in distribution.memories] + [False])
+                if not match.any():
+                    match[-1] = True
+                p = p * match
+                observed = True
+            elif output is self._rt and value > 0:
+                possible = p > 0
+                z = np.zeros(len(p))
+                z[possible] = (np.log(value) - np.log(latencies[possible])) / self._latency_noise
+                p[possible] *= np.exp(-0.5 * z[possible] ** 2) / (value * self._latency_noise * np.sqrt(2 * np.pi))
+                rt = z
+                observed = True
+        if not observed:
+            return None
+        total = p.sum()
+        ll = np.log(max(total, np.finfo(float).tiny))
+        if parameters is None:
+            return ll, None
+        gradient = np.zeros(len(parameters))
+        if total < np.finfo(float).tiny:
+            return ll, gradient
+        # d log L = sum_k p_k d log p_k / sum_k p_k, where p_k is the joint probability of
+        # outcome k (the last one being a failure): a Boltzmann choice over z = [A, T] / s,
+        # times a log-normal density of the retrieval time around log latency F (T - A) / s
+        A = np.nan_to_num(distribution.activations)
+        T, F, s, sigma = self.threshold, self.latency_factor, self.noise, self._latency_noise
+        weights = np.append(distribution.probabilities, distribution.failure_probability)
+        K = len(A)
+        for j, name in enumerate(parameters):
+            dz = np.zeros(K + 1)  # Derivatives of the choice logits
+            dlatency = np.zeros(K + 1)  # Derivatives of the log latencies
+            dsigma = 0.0
+            if name == "decay_rate":
+                dA = self.activation_gradients(distribution.memories) if K > 0 else np.zeros(0)
+                dz[:K] = dA / s
+                dlatency[:K] = -F * dA / s
+            elif name == "noise":
+                dz[:K] = -A / s ** 2
+                dz[K] = -T / s ** 2
+                dlatency[:K] = -F * (T - A) / s ** 2
+                dlatency[K] = F * T / s ** 2
+            elif name == "threshold":
+                dz[K] = 1 / s
+                dlatency[:K] = F / s
+                dlatency[K] = -F / s
+            elif name == "latency_factor":
+                dlatency[:K] = (T - A) / s
+                dlatency[K] = -T / s
+            elif name == "latency_noise":
+                dsigma = 1.0
+            else:
+                raise ValueError("No gradient with respect to %s" % name)
+            dlog = dz - np.dot(weights, dz)
+            if rt is not None:
+                dlog = dlog + rt / sigma * dlatency + dsigma * (rt ** 2 - 1) / sigma
+            gradient[j] = np.dot(p[p > 0], dlog[p > 0]) / total
+        return ll, gradient
+
+class BatchDeclarativeMemory:
+    """The declarative memories of many independent agents, simulated together
+
+    All agents share the chunk vocabulary and the parameters, but each one has its own
+    traces. A trace encoded by every agent at once is stored a single time for the whole
+    batch; traces of some agents only are stored per agent. Encoding and retrieving a cue
+    are a single vectorized step: activations are computed for all agents at once, and
+    responses and retrieval times are sampled for the whole batch.
+
+    Every agent samples its retrievals like DeclarativeMemory.retrieve: a candidate is chosen
+    with the Boltzmann choice rule over the activations of the memories it has encoded, with
+    its retrieval time and retrieval probability, and the retrieval only fails when the agent
+    has no candidate. retrieval_distribution gives the distribution of
+    DeclarativeMemory.retrieval_distribution instead, in which the threshold competes with the
+    candidates"""
+
+    def __init__(self, agents, rng=None):
+        assert isinstance(agents, int) and agents > 0
+        assert rng is None or isinstance(rng, np.random.Generator)
+        self._agents = agents
+        self._rng = rng if rng is not None else np.random.default_rng()
+        self._noise = 0.2
+        self._decay_rate = 0.5
+        self._threshold = 0
+        self._latency_factor = 1.0
+        self.reset()
+
+    @property
+    def agents(self):
+        return self._agents
+
+    @property
+    def rng(self):
+        return self._rng
+
+    @rng.setter
+    def rng(self, rng):
+        assert isinstance(rng, np.random.Generator)
+        self._rng = rng
+
+    @property
+    def time(self):
+        return self._time
+
+    @time.setter
+    def time(self, value):
+        assert isinstance(value, Number)
+        self._time = value
+
+    @property
+    def noise(self):
+        return self._noise
+
+    @noise.setter
+    def noise(self, value):
+        assert isinstance(value, Number)
+        assert value > 0
+        self._noise = value
+
+    @property
+    def decay_rate(self):
+        return self._decay_rate
+
+    @decay_rate.setter
+    def decay_rate(self, value):
+        assert isinstance(value, Number)
+        assert value > 0
+        self._decay_rate = value
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, value):
+        assert isinstance(value, Number)
+        self._threshold = value
+
+    @property
+    def latency_factor(self):
+        return self._latency_factor
+
+    @latency_factor.setter
+    def latency_factor(self, value):
+        assert isinstance(value, Number)
+        self._latency_factor = value
+
+    @property
+    def chunks(self):
+        """The contents of every memory, by id"""
+        return self._chunks
+
+    def reset(self):
+        self._chunks = []  # Contents by id
+        self._index = {}  # chunk_key -> id
+        self._postings = {}  # (slot, value) -> set of ids
+        self._shared = []  # id -> times of the traces of every agent
+        self._private = []  # id -> [agents, times] of the traces of some agents
+        self._created = np.full((self._agents, 0), np.inf)
+        self.time = 0.0
+
+    def _chunk_id(self, contents):
+        key = chunk_key(contents)
+        i = self._index.get(key)
+        if i is None:
+            i = len(self._chunks)
+            self._chunks.append(key)
+            self._index[key] = i
+            self._shared.append([])
+            self._private.append([np.empty(0, dtype=np.intp), np.empty(0, dtype=float)])
+            for item in key.interned_items():
+                self._postings.setdefault(item, set()).add(i)
+            if i >= self._created.shape[1]:
+                created = np.full((self._agents, max(2 * self._created.shape[1], 8)), np.inf)
+                created[:, :i] = self._created[:, :i]
+                self._created = created
+        return i
+
+    def _add_private(self, agents, chunk):
+        traces = self._private[chunk]
+        traces[0] = np.append(traces[0], agents)
+        traces[1] = np.append(traces[1], np.full(len(agents), self.time))
+        self._created[agents, chunk] = np.minimum(self._created[agents, chunk], self.time)
+
+    def encode(self, contents, agents=None):
+        """Adds a trace of the same chunk for every agent (or for a boolean mask of agents)"""
+        assert isinstance(contents, (dict, Chunk))
+        i = self._chunk_id(contents)
+        if agents is None:
+            self._shared[i].append(self.time)
+            np.minimum(self._created[:, i], self.time, out=self._created[:, i])
+        else:
+            self._add_private(np.flatnonzero(agents), i)
+
+    def encode_ids(self, ids):
+        """Adds a trace of a possibly different memory for every agent; negative ids are skipped"""
+        ids = np.asarray(ids, dtype=np.intp)
+        assert ids.shape == (self._agents,)
+        for i in np.unique(ids[ids >= 0]):
+            self._add_private(np.flatnonzero(ids == i), i)
+
+    def matching(self, cue):
+        """Returns the sorted ids of the memories whose contents include all the slot-values of the cue"""
+        assert isinstance(cue, (dict, Chunk))
+        if len(cue) == 0:
+            return np.arange(len(self._chunks), dtype=np.intp)
+        postings = []
+        for item in lookup_items(cue):
+            posting = self._postings.get(item)
+            if posting is None:
+                return np.empty(0, dtype=np.intp)
+            postings.append(posting)
+        postings.sort(key=len)
+        return np.array(sorted(postings[0].intersection(*postings[1:])), dtype=np.intp)
+
+    def activations(self, ids=None, time=None):
+        """Returns the agents x memories matrix of activations (nan where an agent has no past trace)"""
+        if time is None:
+            time = self.time
+        if ids is None:
+            ids = np.arange(len(self._chunks), dtype=np.intp)
+        d = self.decay_rate
+        odds = np.zeros((self._agents, len(ids)))
+        for j, i in enumerate(ids):
+            lags = time - np.asarray(self._shared[i], dtype=float)
+            odds[:, j] = np.power(lags[lags > 0], -d).sum()
+            agents, times = self._private[i]
+            if len(agents) > 0:
+                lags = time - times
+                past = lags > 0
+                odds[:, j] += np.bincount(agents[past], weights=np.power(lags[past], -d), minlength=self._agents)
+        with np.errstate(divide="ignore"):
+            activations = np.log(odds)
+        activations[odds <= 0] = np.nan
+        return activations
+
+    def retrieval_distribution(self, cue):
+        """Returns the candidate ids, and the agents x (candidates + failure) matrices of
+        choice probabilities and latencies; the last column is the retrieval failure"""
+        ids = self.matching(cue)
+        A = self.activations(ids)
+        A[~(self._created[:, ids] < self.time)] = np.nan
+        T = self.threshold
+        F = self.latency_factor
+        s = self.noise
+        z = np.concatenate([np.where(np.isnan(A), -np.inf, A), np.full((self._agents, 1), T)], axis=1) / s
+        weights = np.exp(z - z.max(axis=1, keepdims=True))
+        weights /= weights.sum(axis=1, keepdims=True)
+        latencies = np.concatenate([np.exp(F * (-A + T) / s), np.full((self._agents, 1), np.exp(F * (-T) / s))],
+                                   axis=1)
+        return ids, weights, latencies
+
+    def retrieve(self, cue):
+        """Samples one retrieval of a cue for every agent"""
+        T = self.threshold
+        F = self.latency_factor
+        s = self.noise
+        ids = self.matching(cue)
+        A = self.activations(ids)
+        A[~(self._created[:, ids] < self.time)] = np.nan
+        failed = np.isnan(A).all(axis=1)
+        if len(ids) == 0:
+            retrieved = np.full(self._agents, -1, dtype=np.intp)
+            activation = np.full(self._agents, np.nan)
+        else:
+            z = np.where(np.isnan(A), -np.inf, A) / s
+            z -= np.where(failed, 0.0, z.max(axis=1))[:, None]
+            weights = np.cumsum(np.exp(z), axis=1)
+            u = self._rng.random(self._agents) * weights[:, -1]
+            chosen = np.minimum((weights <= u[:, None]).sum(axis=1), len(ids) - 1)
+            retrieved = np.where(failed, -1, ids[chosen])
+            activation = np.where(failed, np.nan, A[np.arange(self._agents), chosen])
+        rt = np.where(failed, np.exp(F * (-T) / s), np.exp(F * (-activation + T) / s))
+        probabilities = 1 / (1 + np.exp((-activation + T) / s))
+        chunks = np.empty(self._agents, dtype=object)
+        chunks[:] = [None if i < 0 else self._chunks[i] for i in retrieved]
+        return BatchRetrieval(retrieved, chunks, rt, probabilities)
+
+    def responses(self, retrieval, slot):
+        """Returns the value of a slot in each agent's retrieved chunk (None for failures)"""
+        return np.array([None if c is None else c.get(slot) for c in retrieval.chunks], dtype=object)
+
+
+def _segment_logsumexp(values, starts, segments):
+    """Returns log(sum(exp(values))) over each segment of a flat array (-inf for segments of -inf)"""
+    peaks = np.maximum.reduceat(values, starts)
+    peaks = np.where(np.isfinite(peaks), peaks, 0.0)
+    with np.errstate(divide="ignore"):
+        return np.log(np.add.reduceat(np.exp(values - peaks[segments]), starts)) + peaks
+
+
+class TraceLags:
+    """The log-lags of the traces of every candidate of every observed retrieval of a module,
+    recorded once during a replay, in flat arrays
+
+    The timing of the traces and the candidates of each retrieval do not depend on the
+    parameters, so the likelihood of the whole replay can be recomputed for any parameters
+    with a few vectorized operations: A = logsumexp(-d * log lag) per candidate, then the
+    choice and latency terms of DeclarativeMemory.log_likelihood per retrieval"""
+
+    def __init__(self):
+        self._lags = []  # Log-lags of each candidate's past traces
+        self._matches = []  # Per retrieval, whether each outcome (candidates, then failure) matches the response
+        self._rts = []
+        self._compiled = None  # Number of retrievals flattened into the arrays
+
+    def __len__(self):
+        return len(self._rts)
+
+    def record(self, memory, observations):
+        """Records the current analytic retrieval of a DeclarativeMemory if any observation applies to it"""
+        distribution = memory.distribution
+        if distribution is None:
+            return
+        ids = np.array([m._id for m in distribution.memories], dtype=np.intp)
+        match = np.ones(len(ids) + 1, dtype=bool)
+        rt = np.nan
+        observed = False
+        for output, extract, value in observations:
+            if value is None:
+                continue
+            if output is memory._retrieval:
+                value = extern(value)
+                match = np.array([m.get(extract) == value for m in distribution.memories] + [False])
+                if not match.any():
+                    match[-1] = True
+                observed = True
+            elif output is memory._rt and value > 0:
+                rt = value
+                observed = True
+        if not observed:
+            return
+        traces = memory._traces
+        lags = memory.time - traces.times
+        past = (lags > 0) & np.isin(traces.chunks, ids)
+        position = np.searchsorted(ids, traces.chunks[past])
+        order = np.argsort(position, kind="stable")
+        counts = np.bincount(position, minlength=len(ids))
+        # Candidates without a past trace have no activation and cannot be retrieved
+        lags = np.split(np.log(lags[past][order]), np.cumsum(counts)[:-1]) if len(ids) > 0 else []
+        self._lags.append([l for l, n in zip(lags, counts) if n > 0])
+        self._matches.append(np.append(match[:-1][counts > 0], match[-1]))
+        self._rts.append(rt)
+
+    def _compile(self):
+        """Flattens the recorded retrievals into arrays indexed by candidate and by outcome"""
+        lags = [l for retrieval in self._lags for l in retrieval]
+        counts = np.array([len(retrieval) for retrieval in self._lags], dtype=np.intp)
+        self._loglags = np.concatenate(lags) if lags else np.empty(0)
+        sizes = np.array([len(l) for l in lags], dtype=np.intp)
+        self._candidate_starts = np.cumsum(sizes) - sizes
+        self._candidate_of_lag = np.repeat(np.arange(len(lags)), sizes)
+        outcomes = counts + 1
+        self._outcome_starts = np.cumsum(outcomes) - outcomes
+        self._retrieval_of_outcome = np.repeat(np.arange(len(counts)), outcomes)
+        self._failure = np.zeros(outcomes.sum(), dtype=bool)
+        self._failure[self._outcome_starts + counts] = True
+        self._candidate_of_outcome = np.zeros(outcomes.sum(), dtype=np.intp)
+        self._candidate_of_outcome[~self._failure] = np.arange(len(lags))
+        self._match = np.concatenate(self._matches) if self._matches else np.empty(0, dtype=bool)
+        self._rt = np.array(self._rts, dtype=float)
+        self._compiled = len(self._rts)
+
+    def activations(self, decay_rate):
+        """Returns the activation of every candidate of every recorded retrieval, which only
+        depends on the decay rate and can be shared by evaluations that differ in other parameters"""
+        if self._compiled != len(self._rts):
+            self._compile()
+        if len(self._loglags) == 0:
+            return np.empty(0)
+        return _segment_logsumexp(-decay_rate * self._loglags, self._candidate_starts, self._candidate_of_lag)
+
+    def log_likelihood(self, decay_rate, noise, threshold, latency_factor, latency_noise, parameters=None,
+                       activations=None):
+        """Returns the total log-likelihood of the recorded retrievals for the given parameter values,
+        and its gradient with respect to the named parameters if any are given
+
+        activations, if given, must have been computed by activations(decay_rate)"""
+        if self._compiled != len(self._rts):
+            self._compile()
+        d, s, T, F, sigma = decay_rate, noise, threshold, latency_factor, latency_noise
+        L = self._loglags
+        if len(self._rt) == 0:
+            return 0.0, None if parameters is None else np.zeros(len(parameters))
+        A = self.activations(d) if activations is None else activations
+        fail = self._failure
+        r = self._retrieval_of_outcome
+        Ao = A[self._candidate_of_outcome] if len(A) > 0 else np.zeros(len(fail))
+        logits = np.where(fail, T, Ao) / s
+        logw = logits - _segment_logsumexp(logits, self._outcome_starts, r)[r]
+        loglatency = np.where(fail, -F * T / s, F * (T - Ao) / s)
+        timed = self._rt > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            logrt = np.log(self._rt)
+            z = np.where(timed[r], (logrt[r] - loglatency) / sigma, 0.0)
+            logq = np.where(self._match, logw, -np.inf)
+            logq += np.where(timed[r], -0.5 * z ** 2 - logrt[r] - np.log(sigma * np.sqrt(2 * np.pi)), 0.0)
+        trials = _segment_logsumexp(logq, self._outcome_starts, r)
+        floor = np.log(np.finfo(float).tiny)
+        ll = np.maximum(trials, floor).sum()
+        if parameters is None:
+            return ll, None
+
+        posterior = np.where(trials[r] > floor, np.exp(logq - trials[r]), 0.0)
+        w = np.exp(logw)
+        if any(name == "decay_rate" for name in parameters) and len(L) > 0:
+            dA = -np.add.reduceat(np.exp(-d * L - A[self._candidate_of_lag]) * L, self._candidate_starts)
+            dAo = np.where(fail, 0.0, dA[self._candidate_of_outcome])
+        else:
+            dAo = np.zeros(len(fail))
+        gradient = np.zeros(len(parameters))
+        zero = np.zeros(len(fail))
+        for j, name in enumerate(parameters):
+            dsigma = 0.0
+            if name == "decay_rate":
+                dz, dlatency = dAo / s, -F * dAo / s
+            elif name == "noise":
+                dz = np.where(fail, -T, -Ao) / s ** 2
+                dlatency = np.where(fail, F * T, -F * (T - Ao)) / s ** 2
+            elif name == "threshold":
+                dz = np.where(fail, 1 / s, 0.0)
+                dlatency = np.where(fail, -F / s, F / s)
+            elif name == "latency_factor":
+                dz, dlatency = zero, np.where(fail, -T, T - Ao) / s
+            elif name == "latency_noise":
+                dz, dlatency, dsigma = zero, zero, 1.0
+            else:
+                raise ValueError("No gradient with respect to %s" % name)
+            dlog = dz - np.add.reduceat(w * dz, self._outcome_starts)[r]
+            dlog += np.where(timed[r], z / sigma * dlatency + dsigma * (z ** 2 - 1) / sigma, 0.0)
+            gradient[j] = np.dot(posterior, dlog)
+        return ll, gradient
@@ -0,0 +1,114 @@
+"""Dataset loaders, synthetic generators and model builders for the benchmarks"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from actrme.models.model import DataModel
+from actrme.modules.declarative import DeclarativeMemory
+
+DATA = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+RESPONSES = ["fish", "book", "beer", "police", "color", "work", "house", "tree", "water", "chair"]
+
+
+def load(name):
+    """Loads one of the bundled datasets by file name (without extension)"""
+    return pd.read_csv(os.path.join(DATA, "%s.csv" % name))
+
+
+def synthetic_memory(subjects=1, items=25, tests=5, seed=0):
+    """Generates a study/test paired-associate experiment shaped like memory_experiment.csv"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for subject in range(subjects):
+        answers = rng.choice(RESPONSES, size=items)
+        trials = [("study", i) for i in range(items)] + [("test", i) for i in range(items) for _ in range(tests)]
+        order = [trials[i] for i in range(items)] + [trials[items + i] for i in rng.permutation(items * tests)]
+        time = 0.0
+        for kind, item in order:
+            time += rng.uniform(2.0, 6.0)
+            correct = kind == "study" or rng.random() < 0.7
+            resp = answers[item] if correct else rng.choice(RESPONSES)
+            rows.append({"subj": 1000 + subject, "item": item + 1, "resp": resp,
+                         "RT": rng.lognormal(0.3, 0.4), "type": kind, "time": round(time, 3),
+                         "acc": int(resp == answers[item])})
+    return pd.DataFrame(rows)
+
+
+def synthetic_rlwm(subjects=1, blocks=10, set_size=3, repetitions=13, seed=0):
+    """Generates a reinforcement-learning / working-memory task shaped like RLWM_learn_data_stag_2023.csv"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for subject in range(subjects):
+        trial = 0
+        for block in range(blocks):
+            correct = rng.integers(1, 4, size=set_size)
+            sequence = rng.permutation(np.repeat(np.arange(set_size), repetitions))
+            for image in sequence:
+                trial += 1
+                response = int(rng.integers(1, 4))
+                rows.append({"subject": 7000 + subject, "acc": int(response == correct[image]),
+                             "RT": rng.lognormal(-0.7, 0.3), "response": response, "imageID": image + 1,
+                             "corResponse": correct[image], "trial": trial,
+                             "blockLength": set_size * repetitions, "setSize": set_size})
+    return pd.DataFrame(rows)
+
+
+def memory_model(data):
+    """Builds the paired-associate model of the examples notebook: study trials are encoded,
+    test trials cue a retrieval of the response"""
+    data = data.copy()
+    data["item"] = data["item"].astype(str)
+    study = data["type"] == "study"
+    data["study_item"] = np.where(study, data["item"], "")
+    data["study_resp"] = np.where(study, data["resp"], "")
+    data["cue_item"] = np.where(study, "", data["item"])
+    data["test_resp"] = np.where(study, "", data["resp"])
+    data["test_rt"] = np.where(study, np.nan, data["RT"])
+    return _model(data, encode={"study_item": "item", "study_resp": "resp"}, cue={"cue_item": "item"},
+                  response=("test_resp", "resp"), rt="test_rt")
+
+
+def rlwm_model(data):
+    """Builds a model of the RLWM task: every image cues a retrieval of its response, and
+    rewarded stimulus-response pairs are encoded"""
+    data = data.copy()
+    image = data["subject"].astype(str) + "-" + data["setSize"].astype(str) + "-" + data["imageID"].astype(str)
+    rewarded = data["acc"] == 1
+    data["time"] = np.arange(len(data)) * 2.0
+    data["cue_image"] = image
+    data["study_image"] = np.where(rewarded, image, "")
+    data["study_response"] = np.where(rewarded, data["response"].astype(str), "")
+    data["observed_response"] = np.where(data["response"] > 0, data["response"].astype(str), "")
+    data["observed_rt"] = np.where(data["RT"] > 0, data["RT"], np.nan)
+    return _model(data, encode={"study_image": "image", "study_response": "response"}, cue={"cue_image": "image"},
+                  response=("observed_response", "response"), rt="observed_rt")
+
+
+def _model(data, encode, cue, response, rt):
+    model = DataModel(data)
+    dm = DeclarativeMemory()
+    model.add_module(dm)
+    model.add_input(dm.get_input("encode"))
+    model.add_input(dm.get_input("cue"))
+    model.add_output(dm.get_output("retrieval"))
+    model.add_output(dm.get_output("retrieval time"))
+    for column, slot in encode.items():
+        model.connect_input(column, dm.get_input("encode"), slot)
+    for column, slot in cue.items():
+        model.connect_input(column, dm.get_input("cue"), slot)
+    model.connect_input("time", model.get_input("time"))
+    model.connect_output(response[0], dm.get_output("retrieval"), response[1])
+    model.connect_output(rt, dm.get_output("retrieval time"))
+    return model, dm
+
+
+DATASETS = {
+    "memory_experiment": lambda: memory_model(load("memory_experiment")),
+    "collins_experiment": lambda: rlwm_model(load("collins_experiment")),
+    "RLWM_learn_data_stag_2023": lambda: rlwm_model(load("RLWM_learn_data_stag_2023")),
+}
@@ -0,0 +1,87 @@
+"""Memory footprint of chunks and IOs
+
+Compares the compact layouts (slotted objects, contents in immutable chunks with
+shared schemas) with the equivalent __dict__-backed layouts, in bytes per object.
+
+    python benchmarks/footprint.py [count]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from actrme.basic import SymbolicIO, NumericIO, Direction
+from actrme.modules.declarative import Memory
+
+
+class DictMemory:
+    """A memory laid out as before slots: a __dict__ and a dict of contents"""
+
+    def __init__(self, creation_time=0.0, contents={}, decay_rate=0.5):
+        self._contents = dict(contents)
+        self._traces = [creation_time]
+        self._decay_rate = decay_rate
+
+
+class DictIO:
+    """An IO laid out as before slots: only a per-instance __dict__"""
+
+    def __init__(self, name, owner=None, direction=Direction.IN):
+        self._name = name
+        self._value = None
+        self._direction = direction
+        self._owner = owner
+
+
+class DictSymbolicIO(DictIO):
+    """A SymbolicIO as before slots, holding a dict of contents"""
+
+    def __init__(self, name, owner=None, direction=Direction.IN):
+        DictIO.__init__(self, name, owner, direction)
+        self._value = {}
+
+
+class DictNumericIO(DictIO):
+    """A NumericIO as before slots"""
+
+    def __init__(self, name, owner=None, direction=Direction.IN):
+        DictIO.__init__(self, name, owner, direction)
+        self._value = 0
+
+
+def bytes_per_object(factory, count):
+    """Returns the memory allocated per object when creating count objects"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / count
+
+
+def chunk_contents(i):
+    return {"item": "item%d" % (i % 500), "resp": "resp%d" % (i % 7), "type": "study"}
+
+
+def footprint(count=100000):
+    """Returns (name, bytes per object before, bytes per object after) for chunks and IOs"""
+    return [
+        ("chunk",
+         bytes_per_object(lambda i: DictMemory(contents=chunk_contents(i)), count),
+         bytes_per_object(lambda i: Memory(contents=chunk_contents(i)), count)),
+        ("symbolic io",
+         bytes_per_object(lambda i: DictSymbolicIO("io", direction=Direction.OUT), count),
+         bytes_per_object(lambda i: SymbolicIO("io", direction=Direction.OUT), count)),
+        ("numeric io",
+         bytes_per_object(lambda i: DictNumericIO("io", direction=Direction.OUT), count),
+         bytes_per_object(lambda i: NumericIO("io", direction=Direction.OUT), count)),
+    ]
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("%-12s %10s %10s" % ("object", "before", "after"))
+    for name, before, after in footprint(count):
+        print("%-12s %10.1f %10.1f" % (name, before, after))
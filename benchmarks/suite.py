@@ -0,0 +1,194 @@
+"""Time and memory benchmarks over the bundled and synthetic datasets
+
+Measures the hot paths at a range of scales:
+
+* activation: Memory.activation() against the number of traces
+* encode / retrieve: DeclarativeMemory.encode() and retrieve() against the number of chunks
+* run: DataModel.run() on every bundled dataset and on synthetic ones of growing size
+* objective: one evaluation of the fitting objective (DataModel.log_likelihood) on the same datasets,
+  by replaying the trials and from the precompiled trace lags
+
+Times are the best of several repeats, in seconds per call; memory is the peak allocated
+during one call, measured in a separate pass so tracing does not inflate the times.
+The results are written as JSON so runs can be compared across commits.
+
+    python benchmarks/suite.py [--quick] [--repeats N] [--output results.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from datasets import DATASETS, load, memory_model, rlwm_model, synthetic_memory, synthetic_rlwm
+
+from actrme.modules.declarative import DeclarativeMemory, Memory
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def measure(function, setup=None, repeats=5):
+    """Returns the best time of repeats calls and the peak memory allocated by one call
+
+    setup, if given, is called before every call and its result passed to function,
+    so state consumed by a call is rebuilt outside the timed region."""
+    def prepare():
+        return setup() if setup is not None else None
+
+    best = float("inf")
+    for _ in range(repeats):
+        state = prepare()
+        gc.collect()
+        start = time.perf_counter()
+        function(state)
+        best = min(best, time.perf_counter() - start)
+    state = prepare()
+    gc.collect()
+    tracemalloc.start()
+    function(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def result(benchmark, scale, seconds, peak):
+    row = {"benchmark": benchmark, "scale": scale, "seconds": seconds, "peak_bytes": peak}
+    print("%-32s %10s %12.6f s %12d B" % (benchmark, scale, seconds, peak), file=sys.stderr)
+    return row
+
+
+def bench_activation(scales, repeats):
+    rows = []
+    for traces in scales:
+        for recent in (None, 1):
+            memory = Memory(creation_time=0.0, contents={"item": "a"}, recent_traces=recent)
+            for t in range(1, traces):
+                memory.add_trace(float(t))
+            now = float(traces + 1)
+            calls = 1000
+            seconds, peak = measure(lambda _: [memory.activation(now) for _ in range(calls)], repeats=repeats)
+            name = "activation" if recent is None else "activation (hybrid)"
+            rows.append(result(name, traces, seconds / calls, peak // calls))
+    return rows
+
+
+def filled_memory(chunks):
+    dm = DeclarativeMemory()
+    for i in range(chunks):
+        dm.time = float(i)
+        dm.encode({"item": "item%d" % i, "category": "cat%d" % (i % 10)})
+    dm.time = float(chunks + 1)
+    return dm
+
+
+def bench_declarative(scales, repeats):
+    rows = []
+    for chunks in scales:
+        def encode(dm):
+            for i in range(chunks):
+                dm.time = float(i)
+                dm.encode({"item": "item%d" % i, "category": "cat%d" % (i % 10)})
+        seconds, peak = measure(encode, setup=DeclarativeMemory, repeats=repeats)
+        rows.append(result("encode", chunks, seconds / chunks, peak // chunks))
+
+        dm = filled_memory(chunks)
+        calls = 100
+        for name, cue in (("retrieve (unique)", {"item": "item0"}), ("retrieve (category)", {"category": "cat0"})):
+            def retrieve(_):
+                for _ in range(calls):
+                    dm.clear_cache()
+                    dm.retrieve(cue)
+            seconds, peak = measure(retrieve, repeats=repeats)
+            rows.append(result(name, chunks, seconds / calls, peak // calls))
+    return rows
+
+
+def bench_models(models, repeats):
+    """Each measurement gets a freshly built model, so that it starts from the observed data
+    and an empty memory whatever the number of repeats"""
+    rows = []
+    for name, build in models:
+        model, _ = build()
+        rows_count = len(model.dataframe)
+
+        seconds, peak = measure(lambda state: state[0].run(), setup=build, repeats=repeats)
+        rows.append(result("run " + name, rows_count, seconds, peak))
+
+        def compiled():
+            model, _ = build()
+            return model, model.compile()
+        seconds, peak = measure(lambda state: state[0].log_likelihood(state[1]), setup=compiled, repeats=repeats)
+        rows.append(result("objective " + name, rows_count, seconds, peak))
+
+        if model.precompilable():
+            def precompiled():
+                model, _ = build()
+                return model.precompile()
+            seconds, peak = measure(lambda state: state.log_likelihood(), setup=precompiled, repeats=repeats)
+            rows.append(result("objective (precompiled) " + name, rows_count, seconds, peak))
+    return rows
+
+
+def model_cases(quick):
+    rlwm_rows = 2000 if quick else 20000
+    cases = [(name, build) for name, build in DATASETS.items() if name != "RLWM_learn_data_stag_2023"]
+    cases.append(("RLWM_learn_data_stag_2023", lambda: rlwm_model(load("RLWM_learn_data_stag_2023").head(rlwm_rows))))
+    for subjects in ((1, 4) if quick else (1, 4, 16)):
+        cases.append(("synthetic memory x%d" % subjects,
+                      lambda subjects=subjects: memory_model(synthetic_memory(subjects, items=50))))
+        cases.append(("synthetic rlwm x%d" % subjects,
+                      lambda subjects=subjects: rlwm_model(synthetic_rlwm(subjects))))
+    return cases
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="smaller scales, for a smoke test")
+    parser.add_argument("--repeats", type=int, default=None, help="timed repeats per benchmark")
+    parser.add_argument("--output", default=None, help="JSON file to write (default: stdout)")
+    args = parser.parse_args(argv)
+    repeats = args.repeats or (2 if args.quick else 5)
+
+    if args.quick:
+        traces, chunks = (10, 100, 1000), (10, 100, 1000)
+    else:
+        traces, chunks = (10, 100, 1000, 10000), (10, 100, 1000, 10000)
+
+    rows = bench_activation(traces, repeats)
+    rows += bench_declarative(chunks, repeats)
+    rows += bench_models(model_cases(args.quick), repeats)
+
+    report = {"metadata": metadata(), "results": rows}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()